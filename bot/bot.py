@@ -10,7 +10,6 @@ import re
 import sys
 import pdb
 import time
-import requests
 import traceback
 
 # additional libraries
@@ -18,28 +17,43 @@ from slackclient import SlackClient
 
 # project-specific libraries
 from . import const
-from .skill.help import help
-from .skill.mnist import mnist
-from .skill.kmeans import kmeans
-from .skill.stylize import stylize
-from .skill.caption import caption
+from . import engine
+from . import cache
+from . import download
+from . import context
+from . import catalogue
 
 
 TIME_FORMAT = '%H:%M:%S'
 ELOG_CHANNEL = 'test_bots'
-# A dictionary of string prompts mapping to functions
-CATALOGUE = {
-    const.HELP_PROMPT       : help.SkillHelp(),
-    const.KMEANS_PROMPT     : kmeans.SkillKmeans(),
-    const.MNIST_PROMPT      : mnist.SkillMnist(),
-    const.STYLIZE_PROMPT    : stylize.SkillStylize(),
-    const.CAPTION_PROMPT    : caption.SkillCaption()
-}
+# A dictionary of string prompts mapping to skills, which are only imported
+# (along with the heavy libraries they use) once they're needed
+CATALOGUE = catalogue.Catalogue({
+    const.HELP_PROMPT       : ('.skill.help.help', 'SkillHelp'),
+    const.KMEANS_PROMPT     : ('.skill.kmeans.kmeans', 'SkillKmeans'),
+    const.MNIST_PROMPT      : ('.skill.mnist.mnist', 'SkillMnist'),
+    const.STYLIZE_PROMPT    : ('.skill.stylize.stylize', 'SkillStylize'),
+    const.CAPTION_PROMPT    : ('.skill.caption.caption', 'SkillCaption')
+})
+# when the bot started, for reporting how long it took to get going
+START_TIME = time.monotonic()
+
+# prompts currently being computed, so duplicates can wait for them
+INFLIGHT = engine.Coalescer()
 
 def log(s):
     '''More informative print debugging'''
     print('[%s]: %s' % (time.strftime(TIME_FORMAT, time.localtime()), str(s)))
 
+def respond(ctx, message):
+    '''Posts a message in reply to a command, outside of any skill.'''
+    CATALOGUE[const.HELP_PROMPT].respond(ctx, message)
+
+def announce_queue(ctx, position):
+    '''Tells the user where their command is in the queue, if it must wait.'''
+    if position > 0:
+        respond(ctx, 'Queued, position %d.' % position)
+
 def post_error(error, client):
     '''Posts stack trace to a channel dedicated to bot maintenance'''
     channels = client.api_call(method='conversations.list', exclude_archived=1)['channels']
@@ -60,45 +74,29 @@ def post_error(error, client):
             text=error,
         )
     
-def download_attached_image(img_url, bot_token):
-    '''Downloads an image from a url'''
-    # sometimes slack packages urls in messages in brackets
-    # these will cause an error unless we remove them
-    if img_url[0] == '<':
-        img_url = img_url[1:-1]
-    
-    headers = {'Authorization': 'Bearer %s' % bot_token}
-    response = requests.get(img_url, headers=headers)
-    
-    if not os.path.isdir(const.TEMP_PATH):
-        os.makedirs(const.TEMP_PATH)
-    
-    with open(const.TEMP_PATH / const.IN_IMG_NAME, 'wb') as image:
-        image.write(response.content)
-
-def parse_bot_commands(slack_events, bot_name, bot_token):
+def parse_bot_commands(slack_events, bot_name):
     '''
     Parses a list of events coming from the Slack RTM API to find bot commands.
-    If a bot prompt is found, this function returns a tuple of prompt and 
-    channel. If its not found, then this function returns None, None.
+    Returns a list with one (prompt, channel, thread, file) tuple for every 
+    mention of the bot in the batch, in the order they arrived. file is the 
+    first attachment of the message, or None if nothing was attached.
     '''
+    commands = []
     for event in slack_events:
         if event['type'] == 'message' and not 'subtype' in event:
             user_name, message = parse_direct_mention(event['text'])
             if user_name == bot_name:
-                # download a file if it was present in the message
-                if 'files' in event:
-                    # file is present
-                    f = event['files'][0]
-                    download_attached_image(f['url_private_download'], bot_token)
+                # remember the file if one was present in the message; it is
+                # downloaded later, by whichever worker handles the command
+                f = event['files'][0] if 'files' in event else None
                 # reply to the parent thread, not the child thread
                 if 'thread_ts' in event:
                     thread = event['thread_ts']
                 else:
                     thread = event['ts']
 
-                return message, event['channel'], thread
-    return None, None, None
+                commands.append((message, event['channel'], thread, f))
+    return commands
 
 def parse_direct_mention(message_text):
     '''
@@ -114,7 +112,38 @@ def parse_direct_mention(message_text):
     else:
         return (None, None)
 
-def handle_prompt(prompt, info):
+def compute(skill, ctx, key):
+    '''
+    Executes a skill and remembers what it replied. Messages sent before the
+    skill ran (e.g. our place in the queue) are not part of its answer.
+    '''
+    start = len(ctx.replies)
+    skill.execute(ctx)
+    replies = ctx.replies[start:]
+    cache.results.put(key, replies, sum(len(reply[1]) for reply in replies))
+    return replies
+
+def run_skill(skill, ctx):
+    '''
+    Executes a skill, unless we've answered the exact same prompt about the 
+    exact same image before (or are answering it right now), in which case we
+    repeat ourselves.
+    '''
+    key = skill.cache_key(ctx)
+    if key is None:
+        skill.execute(ctx)
+        return
+
+    replies = cache.results.get(key)
+    if replies is None:
+        replies, computed = INFLIGHT.run(key, lambda: compute(skill, ctx, key))
+        if computed:
+            log('result cache: %s' % cache.results.stats())
+            return
+    skill.replay(ctx, replies)
+    log('result cache: %s' % cache.results.stats())
+
+def handle_prompt(ctx):
     '''
     Executes bot prompt if the prompt is known. The bot runs continuously and 
     logs errors to a file.
@@ -123,14 +152,23 @@ def handle_prompt(prompt, info):
     # Help is a special Skill that we use to inform the user as to what the bot
     # can and cannot do
     Help = CATALOGUE[const.HELP_PROMPT]
-    Help.set_info(info)
 
     try:
+        # download a file if it was present in the message, unless we
+        # already have it
+        if ctx.file:
+            hit = cache.attachments.get(ctx.file['id'])
+            if hit:
+                ctx.image.digest, ctx.image.data = hit
+            else:
+                ctx.image.data = download.fetch(
+                    ctx.file['url_private_download'], ctx.client.token)
+                ctx.image.digest = cache.attachments.put(ctx.file['id'], ctx.image.data)
+
         # get the first and second words of the sent message (if they exist)
-        words = prompt.split(' ')
-        firstword = words[0]
-        if len(words) > 1:
-            secondword = words[1]
+        firstword = ctx.args[0]
+        if len(ctx.args) > 1:
+            secondword = ctx.args[1]
         else:
             secondword = None
         
@@ -138,24 +176,28 @@ def handle_prompt(prompt, info):
         if firstword == const.HELP_PROMPT:
             # send clarification about a command
             if secondword and secondword in CATALOGUE.keys():
-                CATALOGUE[secondword].set_info(info)
-                CATALOGUE[secondword].help()
+                CATALOGUE[secondword].help(ctx)
             # send general clarification
             else:
-                Help.help()
+                Help.help(ctx)
 
-        elif prompt.startswith(const.ERROR_PROMPT):
+        elif ctx.prompt.startswith(const.ERROR_PROMPT):
             raise Exception('please edit')
   
         # if we recognize the command, then execute it
         elif firstword in CATALOGUE.keys():
-            CATALOGUE[firstword].set_info(info)
-            CATALOGUE[firstword].execute(prompt)
+            if not CATALOGUE.is_ready(firstword):
+                Help.respond(ctx, 'I\'m still waking up, this will take a moment...')
+            run_skill(CATALOGUE[firstword], ctx)
 
         # otherwise, warn the user that we don't understand
         else:
-            Help.execute(prompt)
+            Help.execute(ctx)
     
+    except download.DownloadError as e:
+        # nothing is broken, the user just needs to send a different file
+        Help.respond(ctx, str(e))
+
     except Exception:
         # we don't want the bot to crash because we cannot easily restart it
         # this default response will at least make us aware that there's an 
@@ -165,11 +207,11 @@ def handle_prompt(prompt, info):
         if not os.path.isdir(const.LOG_PATH):
             os.makedirs(const.LOG_PATH)
         with open(str(const.LOG_PATH / 'elog.txt'), 'a') as elog:
-            elog.write('[%s]: %s\n' % (time.strftime(TIME_FORMAT, time.localtime()), prompt))
+            elog.write('[%s]: %s\n' % (time.strftime(TIME_FORMAT, time.localtime()), ctx.prompt))
             elog.write('[%s]: %s\n' % (time.strftime(TIME_FORMAT, time.localtime()), err))
-        post_error(err, info[const.INFO_CLIENT])
+        post_error(err, ctx.client)
         log(err)
-        Help.error()
+        Help.error(ctx)
 
 def launch_bot():
     try:
@@ -182,7 +224,7 @@ def launch_bot():
             # Read bot's user ID by calling Web API method `auth.test`
             bot_name = client.api_call('auth.test')['user_id']
             # connection is successful
-            log('ritai-bot connected and running!')
+            log('ritai-bot connected and running! (%.2fs)' % (time.monotonic() - START_TIME))
             
         return client, bot_name, bot_token
     except:
@@ -190,21 +232,34 @@ def launch_bot():
         log('Connection failed. Exception traceback printed above.')
         return None, None, None
 
+def ready():
+    '''Called once every skill has been loaded.'''
+    log('ritai-bot ready! (%.2fs)' % (time.monotonic() - START_TIME))
+    # start the worker processes only now, with the modules of the skills
+    # that use them, so each worker doesn't import them all over again
+    modules = [type(CATALOGUE[prompt]).__module__ for prompt in CATALOGUE.keys()
+        if CATALOGUE.is_ready(prompt) and CATALOGUE[prompt].cpu_bound]
+    engine.warmup_processes(modules)
+
 def main():
     client, bot_name, bot_token = launch_bot()
     if client:
+        # commands run on worker threads, so that a slow skill doesn't stop us
+        # from reading (and answering) everyone else
+        workers = engine.Engine(handle_prompt)
+        # now that we're listening, load the skills and their models
+        CATALOGUE.warmup(log=log, done=ready)
         while True:
-            # loop forever, checking for mentions every RTM_READ_DELAY
-            prompt, channel, thread = parse_bot_commands(client.rtm_read(), bot_name, bot_token)
-            if prompt:
+            # loop forever, checking for mentions every RTM_READ_DELAY; every
+            # command in the batch is dispatched before we go back to sleep
+            for prompt, channel, thread, f in parse_bot_commands(client.rtm_read(), bot_name):
                 log(prompt)
-                # info is an object that lets the bot keep track of who it's responding to.
-                info = {
-                    const.INFO_CLIENT: client, 
-                    const.INFO_CHANNEL: channel, 
-                    const.INFO_THREAD: thread
-                }
-                handle_prompt(prompt, info)
+                # the context lets the bot keep track of who it's responding to.
+                ctx = context.Context(client, channel, thread, prompt, file=f)
+                position = workers.submit(ctx, 
+                    notify=lambda position: announce_queue(ctx, position))
+                if position is None:
+                    respond(ctx, 'I\'m swamped right now. Please try again in a minute.')
             time.sleep(const.RTM_READ_DELAY)
             
     else:
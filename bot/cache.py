@@ -0,0 +1,176 @@
+# author: Paul Galatic
+#
+# Caches that let repeated commands on the same attachment skip the network
+# and the decoder
+
+# standard lib
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# project lib
+from . import const
+
+def digest(data):
+    '''The content hash by which cached bytes are addressed'''
+    return hashlib.sha1(data).hexdigest()
+
+class LRUCache():
+    '''
+    A thread-safe, least-recently-used cache with a budget in bytes. Entries
+    may also expire after ttl seconds. The caller says how large each value is,
+    since it knows best how to measure it.
+    '''
+
+    def __init__(self, budget, ttl=None):
+        self.budget = budget
+        self.ttl = ttl
+        self.used = 0
+        # key -> (value, size, time of insertion)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''Returns the value stored under key, or None.'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, size, stamp = entry
+                if self.ttl is not None and time.monotonic() - stamp > self.ttl:
+                    self._remove(key)
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def stats(self):
+        '''Summarizes how well the cache is doing, for the logs.'''
+        return '%d hits, %d misses, %d entries, %.1f/%.1f MB' % (self.hits, 
+            self.misses, len(self.entries), self.used / 2**20, self.budget / 2**20)
+
+    def put(self, key, value, size):
+        '''Stores a value, evicting the stalest entries to stay on budget.'''
+        if size > self.budget:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, time.monotonic())
+            self.used += size
+            while self.used > self.budget:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.used -= size
+
+class AttachmentCache():
+    '''
+    Remembers downloaded attachments, keyed by Slack file ID and by content
+    hash. Recent files are kept in memory; beyond that, files are written to
+    a folder on disk that is kept under its own byte budget.
+    '''
+
+    def __init__(self, budget=const.CACHE_MEMORY_BYTES,
+            disk_budget=const.CACHE_DISK_BYTES, path=const.CACHE_PATH):
+        # file id -> content hash
+        self.ids = LRUCache(budget=1 << 16)
+        # content hash -> bytes
+        self.blobs = LRUCache(budget)
+        self.disk_budget = disk_budget
+        self.path = path
+        self.disk_lock = threading.Lock()
+
+    def get(self, file_id):
+        '''Returns (content hash, bytes) of a file we've seen, or None.'''
+        key = self.ids.get(file_id)
+        if key is None and self.disk_budget:
+            key = self._read(self.path / 'ids' / file_id)
+            key = key.decode() if key else None
+        if key is None:
+            return None
+
+        data = self.blobs.get(key)
+        if data is None and self.disk_budget:
+            data = self._read(self.path / key)
+        if data is None:
+            return None
+
+        self.ids.put(file_id, key, 1)
+        self.blobs.put(key, data, len(data))
+        return key, data
+
+    def put(self, file_id, data):
+        '''Remembers a freshly downloaded file, returning its content hash.'''
+        key = digest(data)
+        self.ids.put(file_id, key, 1)
+        self.blobs.put(key, data, len(data))
+        if self.disk_budget and len(data) <= self.disk_budget:
+            self._write(self.path / key, data)
+            self._write(self.path / 'ids' / file_id, key.encode())
+            self._trim()
+        return key
+
+    def _read(self, path):
+        try:
+            with open(str(path), 'rb') as f:
+                data = f.read()
+            # mark the file as recently used
+            os.utime(str(path))
+            return data
+        except OSError:
+            return None
+
+    def _write(self, path, data):
+        # write to a temporary file first, so readers never see half a file
+        os.makedirs(str(path.parent), exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, str(path))
+
+    def _trim(self):
+        '''
+        Deletes the least recently used files until we're on budget, along 
+        with the file ids that pointed at them.
+        '''
+        with self.disk_lock:
+            files = [entry for entry in os.scandir(str(self.path))
+                if entry.is_file() and not entry.name.endswith('.tmp')]
+            used = sum(entry.stat().st_size for entry in files)
+            removed = set()
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+                if used <= self.disk_budget:
+                    break
+                used -= entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                    removed.add(entry.name)
+                except OSError:
+                    pass
+
+            if not removed:
+                return
+            for entry in os.scandir(str(self.path / 'ids')):
+                if entry.name.endswith('.tmp'):
+                    continue
+                key = self._read(entry.path)
+                if key is None or key.decode() in removed:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+# shared by every command
+attachments = AttachmentCache()
+# decoded images, kept around briefly for commands that follow one another
+arrays = LRUCache(const.CACHE_ARRAY_BYTES, ttl=const.CACHE_ARRAY_TTL)
+# the replies of deterministic skills, keyed by what was asked of them
+results = LRUCache(const.CACHE_RESULT_BYTES)
@@ -0,0 +1,75 @@
+# author: Paul Galatic
+#
+# Keeps track of the bot's skills, loading each one (along with the heavy
+# libraries and models it depends on) only once it is needed
+
+# standard lib
+import time
+import threading
+import importlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+class Catalogue():
+    '''
+    Maps prompts to skills. A skill's module isn't imported until the skill
+    is first asked for, or until warmup() loads every skill in the background.
+    Asking for a skill that is still loading waits for that skill only.
+    '''
+
+    def __init__(self, entries):
+        # prompt -> (module, class name) of the skill that answers it
+        self.entries = entries
+        # prompt -> loaded and warmed up skill
+        self.skills = {}
+        # prompt -> set once the skill is ready to answer prompts
+        self.ready = {prompt: threading.Event() for prompt in entries}
+        self.locks = {prompt: threading.Lock() for prompt in entries}
+
+    def keys(self):
+        return self.entries.keys()
+
+    def __contains__(self, prompt):
+        return prompt in self.entries
+
+    def __getitem__(self, prompt):
+        return self.load(prompt)
+
+    def is_ready(self, prompt):
+        return self.ready[prompt].is_set()
+
+    def load(self, prompt):
+        '''Imports, creates and warms up a skill (once) and returns it.'''
+        with self.locks[prompt]:
+            if prompt not in self.skills:
+                module, name = self.entries[prompt]
+                module = importlib.import_module(module, package=__package__)
+                skill = getattr(module, name)()
+                skill.warmup()
+                self.skills[prompt] = skill
+                self.ready[prompt].set()
+        return self.skills[prompt]
+
+    def warmup(self, log=print, done=None):
+        '''
+        Loads every skill at once on background threads, logging how long each
+        one took. Once all of them are ready, done() is called (if given).
+        Returns immediately.
+        '''
+        start = time.monotonic()
+
+        def load(prompt):
+            try:
+                self.load(prompt)
+                log('%s ready in %.2fs' % (prompt, time.monotonic() - start))
+            except Exception:
+                # the skill will be loaded again (and fail loudly) when asked for
+                log('Could not warm up %s:\n%s' % (prompt, traceback.format_exc()))
+
+        def load_all():
+            with ThreadPoolExecutor(max_workers=len(self.entries)) as executor:
+                list(executor.map(load, self.entries))
+            if done:
+                done()
+
+        threading.Thread(target=load_all, daemon=True).start()
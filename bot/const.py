@@ -6,6 +6,7 @@ import os
 import pathlib
 
 VERSION = '0.8'
+DEBUG = bool(os.environ.get('RITAI_DEBUG')) # keep intermediate files on disk
 CWD = pathlib.Path(os.getcwd()) / 'bot'
 
 # shared
@@ -17,10 +18,6 @@ CAPTION_PROMPT  = 'caption'
 ERROR_PROMPT    = 'whoops'
 STASH_PROMPT    = 'stash'
 
-INFO_CLIENT = 'client'
-INFO_CHANNEL = 'channel'
-INFO_THREAD = 'thread'
-
 HEADERS = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
 
 LOG_PATH        = CWD / 'logs'
@@ -28,11 +25,43 @@ MODEL_PATH      = CWD / 'stylize' / 'models'
 STORAGE_PATH    = CWD / 'images' / 'storage'
 TEMP_PATH       = CWD / 'images' / 'temp'
 DEFAULT_PATH    = CWD / 'images' / 'default'
+CACHE_PATH      = CWD / 'images' / 'cache'
 
 # bot.py
 RTM_READ_DELAY  = 2 # second delay between reading from RTM
 MENTION_REGEX = '^<@(|[WU].+?)>(.*)'
 
+# download.py
+DOWNLOAD_MAX_BYTES  = 20 * 2**20 # largest attachment we are willing to read
+DOWNLOAD_MAX_PIXELS = 40 * 10**6 # largest image we are willing to decode
+DOWNLOAD_TIMEOUT    = 30 # seconds
+
+# cache.py
+CACHE_MEMORY_BYTES  = 128 * 2**20 # downloaded attachments kept in memory
+CACHE_DISK_BYTES    = 512 * 2**20 # downloaded attachments kept on disk; 0 disables
+CACHE_ARRAY_BYTES   = 256 * 2**20 # decoded images kept in memory
+CACHE_ARRAY_TTL     = 120 # seconds a decoded image stays in memory
+CACHE_RESULT_BYTES  = 64 * 2**20 # skill replies kept in memory
+
+# engine.py
+ENGINE_THREADS      = 4  # commands that may run at the same time
+ENGINE_QUEUE_DEPTH  = 16 # commands that may wait for a free worker
+ENGINE_PROCESSES    = min(4, os.cpu_count() or 1) # workers for CPU-heavy skills
+
+# kmeans.py
+# threads assigning pixels to clusters, in each worker process
+KMEANS_THREADS = max(1, (os.cpu_count() or 1) // max(1, ENGINE_PROCESSES))
+
+# stylize.py
+STYLIZE_NET_BUDGET  = 256 * 2**20 # memory for loaded style networks, per process
+STYLIZE_PRELOAD     = ['mosaic', 'candy', 'starry_night'] # styles loaded at startup
+STYLIZE_FAST_PIXELS = 640 * 480 # largest image stylized in fast mode
+STYLIZE_FULL_PIXELS = 12 * 10**6 # largest image stylized in full mode
+STYLIZE_TILE        = 512 # side of the tiles larger images are stylized in
+STYLIZE_TILE_OVERLAP = 64 # pixels neighbouring tiles share, to blend seams
+STYLIZE_BATCH_WINDOW = 0.02 # seconds to wait for more requests of a style
+STYLIZE_BATCH_SIZE  = 4 # most fast mode requests stylized in one pass
+
 # command.py
 DEFAULT_IMG_NAME = 'default.png'
 IN_IMG_NAME = 'in.png'
@@ -0,0 +1,31 @@
+# author: Paul Galatic
+#
+# Everything a skill needs to know about the prompt it is answering
+
+# project lib
+from . import image
+
+class Context():
+    '''
+    A Context is created for every prompt the bot receives and is handed to
+    the skill that answers it. Because skills keep no per-prompt state of
+    their own, one skill object can answer any number of prompts at once.
+    '''
+
+    def __init__(self, client, channel, thread, prompt, file=None, img=None):
+        # the slack client, which the bot uses to respond
+        self.client = client
+        # the channel in which we are participating
+        self.channel = channel
+        # the particular thread we were created to respond to
+        self.thread = thread
+        # the message sent to the bot, and the words it is made of
+        self.prompt = prompt
+        self.args = prompt.split(' ')
+        # the slack file attached to the message, if any
+        self.file = file
+        # the image attached to the message, once it has been downloaded
+        self.image = img if img else image.RequestImage()
+        # everything the bot has said in reply, as ('text', message) and 
+        # ('image', bytes, comment) tuples, so the replies can be replayed
+        self.replies = []
@@ -0,0 +1,106 @@
+# author: Paul Galatic
+#
+# Downloads attachments over a pool of persistent connections, refusing any
+# file that is too large before it has a chance to eat up memory
+
+# standard lib
+import time
+import struct
+import threading
+
+# required lib
+import requests
+from requests.adapters import HTTPAdapter
+
+# project lib
+from . import const
+
+CHUNK_SIZE = 1 << 16
+
+class DownloadError(Exception):
+    '''Raised when an attachment can't or shouldn't be downloaded.'''
+    pass
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    '''
+    Lazily creates the session shared by every download. Reusing it keeps
+    connections to Slack open, so we only pay for the TLS handshake once.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                pool_maxsize=const.ENGINE_THREADS)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+def sniff_size(data):
+    '''
+    Reads the dimensions of a PNG, GIF, or JPEG image from its first bytes.
+    Returns (width, height), or None if they can't be found (yet).
+    '''
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    if data[:2] == b'\xff\xd8':
+        # walk the JPEG segments until we hit a start-of-frame marker
+        idx = 2
+        while idx + 9 < len(data):
+            if data[idx] != 0xff:
+                return None
+            marker = data[idx + 1]
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack('>HH', data[idx + 5:idx + 9])
+                return width, height
+            length, = struct.unpack('>H', data[idx + 2:idx + 4])
+            idx += 2 + length
+    return None
+
+def fetch(url, token, max_bytes=const.DOWNLOAD_MAX_BYTES,
+        max_pixels=const.DOWNLOAD_MAX_PIXELS, timeout=const.DOWNLOAD_TIMEOUT):
+    '''
+    Downloads a file from Slack and returns its bytes. The file is streamed
+    in chunks, and the download is abandoned as soon as it is clear that the
+    file has more than max_bytes bytes or more than max_pixels pixels, or once
+    more than timeout seconds have passed.
+    '''
+    # sometimes slack packages urls in messages in brackets
+    # these will cause an error unless we remove them
+    if url[0] == '<':
+        url = url[1:-1]
+
+    headers = {'Authorization': 'Bearer %s' % token}
+    deadline = time.monotonic() + timeout
+    try:
+        with get_session().get(url, headers=headers, stream=True,
+                timeout=timeout) as response:
+            response.raise_for_status()
+
+            length = response.headers.get('Content-Length')
+            if length and int(length) > max_bytes:
+                raise DownloadError('That file is too large (%.1f MB, the limit is %.1f MB).' %
+                    (int(length) / 2**20, max_bytes / 2**20))
+
+            data = bytearray()
+            size = None
+            for chunk in response.iter_content(CHUNK_SIZE):
+                data.extend(chunk)
+                if len(data) > max_bytes:
+                    raise DownloadError('That file is too large (the limit is %.1f MB).' %
+                        (max_bytes / 2**20))
+                if time.monotonic() > deadline:
+                    raise DownloadError('That file took too long to download.')
+                # check the dimensions as soon as the header has arrived
+                if size is None:
+                    size = sniff_size(data)
+                    if size and size[0] * size[1] > max_pixels:
+                        raise DownloadError('That image is too large (%dx%d).' % size)
+            return bytes(data)
+    except requests.exceptions.RequestException as e:
+        raise DownloadError('I couldn\'t download that file (%s).' % type(e).__name__)
@@ -0,0 +1,267 @@
+# author: Paul Galatic
+#
+# Execution engine for bot commands. Parsed commands are handed to a bounded
+# pool of worker threads so that the RTM loop never blocks on a slow skill, and
+# CPU-heavy skills can push their number crunching into a pool of processes.
+
+# standard lib
+import threading
+import itertools
+import traceback
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# project lib
+from . import const
+
+class Engine():
+    '''
+    Runs commands on a fixed number of worker threads. Commands that arrive
+    while every worker is busy wait in a queue of bounded depth; once that
+    queue is full, further commands are refused until there is room again.
+    '''
+
+    def __init__(self, handler, threads=const.ENGINE_THREADS,
+            depth=const.ENGINE_QUEUE_DEPTH):
+        # the function that actually executes a command
+        self.handler = handler
+        self.threads = threads
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        # number of commands that have been accepted but have not finished
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, *args, notify=None):
+        '''
+        Queues a command for execution. Returns the command's position in the
+        queue (0 if it starts immediately), or None if the queue is full. If 
+        given, notify(position) is called before the command can start, so
+        that anything it says comes before the command's own replies.
+        '''
+        with self.lock:
+            if self.pending >= self.threads + self.depth:
+                return None
+            position = max(0, self.pending - self.threads + 1)
+            self.pending += 1
+
+        try:
+            if notify:
+                notify(position)
+        finally:
+            self.executor.submit(self._run, *args)
+        return position
+
+    def _run(self, *args):
+        try:
+            self.handler(*args)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def shutdown(self, wait=True):
+        '''Stops accepting commands, optionally waiting for queued ones.'''
+        self.executor.shutdown(wait=wait)
+
+class Coalescer():
+    '''
+    Lets identical jobs that overlap in time share a single computation: the
+    first one does the work, and the rest wait for it and take its result.
+    '''
+
+    def __init__(self):
+        # key -> Future of the job currently computing that key
+        self.jobs = {}
+        # key -> number of callers waiting for that job's result
+        self.followers = {}
+        self.lock = threading.Lock()
+
+    def run(self, key, fn):
+        '''
+        Runs fn(), unless a job with the same key is already running, in which
+        case its result is awaited instead. Returns the result and whether fn
+        was run by this call. If the running job fails, so do its followers.
+        '''
+        with self.lock:
+            future = self.jobs.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.jobs[key] = future
+            else:
+                self.followers[key] = self.followers.get(key, 0) + 1
+
+        if not leader:
+            return future.result(), False
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, True
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.jobs[key]
+                self.followers.pop(key, None)
+
+class Batcher():
+    '''
+    Gathers items submitted under the same key, for up to window seconds or
+    until max_size of them have arrived, and hands them to fn(key, items) in
+    one call. fn must return one result per item, in order. The first item
+    of a batch waits out the window and runs fn on behalf of the others.
+    '''
+
+    def __init__(self, fn, window, max_size):
+        self.fn = fn
+        self.window = window
+        self.max_size = max_size
+        # key -> (items, Future of their results, Event set once full) of
+        # the batch still accepting items
+        self.open = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, item):
+        '''Adds an item to a batch and returns its result once ready.'''
+        with self.lock:
+            batch = self.open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.open[key] = ([], Future(), threading.Event())
+            items, future, full = batch
+            index = len(items)
+            items.append(item)
+            if len(items) >= self.max_size:
+                del self.open[key]
+                full.set()
+
+        if leader:
+            full.wait(self.window)
+            with self.lock:
+                if self.open.get(key) is batch:
+                    del self.open[key]
+            try:
+                future.set_result(self.fn(key, items))
+            except BaseException as e:
+                future.set_exception(e)
+
+        return future.result()[index]
+
+_process_pool = None
+_process_lock = threading.Lock()
+# forking the bot itself is unsafe once its threads (and those of libraries
+# like cv2) are running, so workers come from a single-threaded fork server
+_mp_context = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+    else 'spawn')
+if _mp_context.get_start_method() == 'forkserver':
+    # by default the fork server imports __main__, i.e. runs the bot again
+    _mp_context.set_forkserver_preload([])
+# (fn, args) to run in every worker process before its first job
+_initializers = []
+# how many of those have run in this (worker) process
+_initialized = 0
+
+def _init_worker(initializers):
+    '''
+    Runs the initializers this process hasn't run yet. One that fails is 
+    reported but doesn't stop the worker; whatever it was preparing is just
+    done (or fails loudly) when a job needs it.
+    '''
+    global _initialized
+    for fn, args in initializers[_initialized:]:
+        _initialized += 1
+        try:
+            fn(*args)
+        except Exception:
+            traceback.print_exc()
+
+def _run(initializers, fn, args, kwargs):
+    # catch up on anything preloaded after this worker started
+    _init_worker(initializers)
+    return fn(*args, **kwargs)
+
+def get_process_pool():
+    '''Lazily creates the process pool shared by all CPU-heavy skills.'''
+    global _process_pool
+    with _process_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=const.ENGINE_PROCESSES,
+                mp_context=_mp_context,
+                initializer=_init_worker,
+                initargs=(list(_initializers),))
+        return _process_pool
+
+def preload(fn, *args):
+    '''
+    Runs fn (e.g. to load a model) wherever offloaded work runs: in every
+    worker process as it starts, or right away if there are no processes.
+    Workers that have already started run it before their next job.
+    '''
+    if const.ENGINE_PROCESSES < 1:
+        fn(*args)
+    else:
+        with _process_lock:
+            _initializers.append((fn, args))
+
+def reset_process_pool():
+    '''Throws away a broken process pool so the next call makes a new one.'''
+    global _process_pool
+    with _process_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False)
+        _process_pool = None
+
+def _noop():
+    pass
+
+def warmup_processes(modules=()):
+    '''
+    Starts the worker processes ahead of the first CPU-heavy command. The 
+    given modules are imported once, by the fork server, so that every worker
+    starts with them loaded. This only works if no pool has been started yet.
+    '''
+    if const.ENGINE_PROCESSES > 0:
+        if _mp_context.get_start_method() == 'forkserver':
+            _mp_context.set_forkserver_preload(list(modules))
+        pool = get_process_pool()
+        jobs = [pool.submit(_run, list(_initializers), _noop, (), {})
+            for _ in range(const.ENGINE_PROCESSES)]
+        for future in jobs:
+            future.result()
+
+def offload(fn, *args, **kwargs):
+    '''
+    Runs fn in the shared process pool and blocks the calling thread until it
+    returns. The function and its arguments must be picklable, so fn should
+    be a module-level function. If no processes are configured, fn simply
+    runs in the calling thread.
+    '''
+    if const.ENGINE_PROCESSES < 1:
+        return fn(*args, **kwargs)
+    try:
+        return get_process_pool().submit(_run, list(_initializers), fn, args,
+            kwargs).result()
+    except BrokenProcessPool:
+        # a worker died (e.g. it ran out of memory); don't let that take every
+        # later request down with it
+        reset_process_pool()
+        raise
+
+def offload_map(fn, *iterables):
+    '''
+    Like offload, but calls fn once per set of arguments, spreading the calls
+    across the process pool, and returns their results in order.
+    '''
+    if const.ENGINE_PROCESSES < 1:
+        return list(map(fn, *iterables))
+    try:
+        return list(get_process_pool().map(_run, itertools.repeat(list(_initializers)),
+            itertools.repeat(fn), zip(*iterables), itertools.repeat({})))
+    except BrokenProcessPool:
+        reset_process_pool()
+        raise
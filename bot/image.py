@@ -0,0 +1,120 @@
+# author: Paul Galatic
+#
+# Keeps the image attached to a command in memory, from download to upload, so
+# that concurrent commands never trample each other's files on disk
+
+# standard lib
+import os
+
+# project lib
+from . import const
+from . import cache
+
+_default = None
+
+def default_bytes():
+    '''Reads the default image, which is used when nothing was attached.'''
+    global _default
+    if _default is None:
+        path = const.DEFAULT_PATH / const.DEFAULT_IMG_NAME
+        if not os.path.isfile(str(path)): # if image is missing, there's a real problem
+            raise Exception('Default image is missing: {path}'.format(path=path))
+        with open(str(path), 'rb') as f:
+            _default = f.read()
+    return _default
+
+def dump(data, fname):
+    '''Writes raw image bytes to the temp folder, for debugging'''
+    if not os.path.isdir((const.TEMP_PATH)):
+        os.makedirs(str(const.TEMP_PATH))
+    with open(str(const.TEMP_PATH / fname), 'wb') as f:
+        f.write(data)
+
+def encode(array, ext='.png'):
+    '''Encodes an image array into bytes in the given format.'''
+    import cv2
+
+    ok, buf = cv2.imencode(ext, array)
+    if not ok:
+        raise Exception('Could not encode output image as %s' % ext)
+    return buf.tobytes()
+
+def contact_sheet(tiles, captions, columns=3, margin=8, caption_height=28):
+    '''
+    Lays out images in a grid, each with a caption underneath, on a white 
+    background. Every tile is scaled to the size of the first one.
+    '''
+    import cv2
+    import numpy as np
+
+    h, w = tiles[0].shape[:2]
+    rows = -(-len(tiles) // columns)
+    cell_h, cell_w = h + caption_height + margin, w + margin
+    sheet = np.full((rows * cell_h + margin, columns * cell_w + margin, 3), 255, dtype=np.uint8)
+    for idx, (tile, caption) in enumerate(zip(tiles, captions)):
+        if tile.shape[:2] != (h, w):
+            tile = cv2.resize(tile, (w, h), interpolation=cv2.INTER_AREA)
+        row, col = divmod(idx, columns)
+        y, x = margin + row * cell_h, margin + col * cell_w
+        sheet[y:y + h, x:x + w] = np.clip(tile, 0, 255)
+        cv2.putText(sheet, caption, (x, y + h + caption_height - 8),
+            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1, cv2.LINE_AA)
+    return sheet
+
+class RequestImage():
+    '''
+    The image that belongs to a single command. The downloaded bytes are
+    decoded at most once, and the result is encoded straight into a buffer
+    that can be uploaded. Nothing touches the disk unless const.DEBUG is set.
+    '''
+
+    def __init__(self, data=None, digest=None):
+        # the raw bytes of the attachment, or None if there wasn't one
+        self.data = data
+        # the content hash of those bytes, computed when first needed
+        self.digest = digest
+        # the decoded attachment, filled in the first time someone asks
+        self.array = None
+        # the encoded result, ready to upload
+        self.output = None
+
+    def key(self):
+        '''Returns the content hash of the attachment, or None.'''
+        if self.digest is None and self.data:
+            self.digest = cache.digest(self.data)
+        return self.digest
+
+    def decode(self):
+        '''
+        Returns the image as a BGR array. If nothing usable was attached,
+        returns the default image instead. Recently decoded images are shared
+        between commands, so the array must not be modified in place.
+        '''
+        # imported here so that the bot can connect before these are loaded
+        import cv2
+        import numpy as np
+
+        if self.array is None:
+            if self.data:
+                if const.DEBUG:
+                    dump(self.data, const.IN_IMG_NAME)
+                self.array = cache.arrays.get(self.key())
+                if self.array is None:
+                    buf = np.frombuffer(self.data, dtype=np.uint8)
+                    self.array = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+                    if self.array is not None:
+                        cache.arrays.put(self.key(), self.array, self.array.nbytes)
+            if self.array is None: # undecodable attachments yield None
+                buf = np.frombuffer(default_bytes(), dtype=np.uint8)
+                self.array = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        return self.array
+
+    def encode(self, array, ext='.png'):
+        '''Encodes an array as the result of this command.'''
+        self.set_output(encode(array, ext))
+
+    def set_output(self, data):
+        '''Uses an already encoded image as the result of this command.'''
+        self.output = data
+        if const.DEBUG:
+            dump(self.output, const.OUT_IMG_NAME)
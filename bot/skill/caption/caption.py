@@ -50,31 +50,34 @@ def download_and_extract_model(dest):
         download_gdrive_file(WORD_MAP_ID, str(dest / WORD_MAP_NAME))
 
 class SkillCaption(skill.Skill):
+
+    # there's nothing worth remembering until captioning is implemented
+    memoize = False
     
     def __init__(self):
         super().__init__()
 
-    def help(self):
-        self.respond(
+    def help(self, ctx):
+        self.respond(ctx,
             'usage:\n' +\
                 '\t@ritai caption <image>\n' +\
                 '\t\tI will do my best to describe the contents of the image.\n'
         )
         
-    def execute(self, prompt):
+    def execute(self, ctx):
         '''
         Captions an image using a neural network.
         '''
-        prompt_list = prompt.split(' ')
+        prompt_list = ctx.args
         
         # warn the user if they provided too many arguments
         if len(prompt_list) > 1:
-            self.respond('Invalid numer of arguments: %d' % len(prompt_list))
+            self.respond(ctx, 'Invalid numer of arguments: %d' % len(prompt_list))
             return
         
         # perform caption
-        img = self.read_image()
+        img = self.read_image(ctx)
         caption = 'NOT IMPLEMENTED YET'
         
         # post image to channel
-        self.respond(caption)
\ No newline at end of file
+        self.respond(ctx, caption)
\ No newline at end of file
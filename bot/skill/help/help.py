@@ -9,12 +9,15 @@ from .. import skill
 MAX_LEN = 30
 
 class SkillHelp(skill.Skill):
+
+    # answering is cheaper than remembering the answer
+    memoize = False
     
     def __init__(self):
         super().__init__()
 
-    def help(self):
-        self.respond(
+    def help(self, ctx):
+        self.respond(ctx,
             'RITAI VERSION [%s]:\n' % const.VERSION +\
                 '\t@ritai help [command]\n' +\
                 '\t\tprints this message, or more info about a command\n' +\
@@ -26,10 +29,11 @@ class SkillHelp(skill.Skill):
                 '\t\tapplies neural style transfer to an image\n'
         )
     
-    def execute(self, prompt):
+    def execute(self, ctx):
+        prompt = ctx.prompt
         if len(prompt) > MAX_LEN + 3: # add three for the ellipsis
             prompt = '{short}...'.format(short=prompt[:MAX_LEN])
-        self.respond('Unknown prompt: {}. Try @ritai help'.format(prompt))
+        self.respond(ctx, 'Unknown prompt: {}. Try @ritai help'.format(prompt))
         
-    def error(self):
-        self.respond('There\'s been an error. Whoops, please edit.')
\ No newline at end of file
+    def error(self, ctx):
+        self.respond(ctx, 'There\'s been an error. Whoops, please edit.')
\ No newline at end of file
@@ -5,111 +5,384 @@
 #
 
 # standard lib
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # required lib
 import numpy as np
+from PIL import Image
 from scipy import misc
 
 # project lib
+from ... import const
+from ... import image
 from .. import skill
 
-def closest_centroids(points, centroids):
+# pixels assigned to centroids at a time, which caps the memory used for the
+# distance matrix at CHUNK_SIZE * k floats
+CHUNK_SIZE = 1 << 16
+# pixels considered when choosing the initial centroids
+SAMPLE_SIZE = 10000
+# kmeans stops once an iteration improves the fit (the sum of squared 
+# distances from pixels to their centroids) by less than this fraction...
+TOLERANCE = 0.01
+# ...or after this many iterations
+MAX_ITER = 10
+# bits per channel kept when binning pixels into a color histogram
+HISTOGRAM_BITS = 5
+
+# cluster every pixel
+FULL_MODE = 'full'
+# cluster the distinct colors of the image, weighted by how common they are
+HISTOGRAM_MODE = 'hist'
+# cluster a sample of the pixels, then color the image through a lookup table
+LOOKUP_MODE = 'fast'
+MODES = [FULL_MODE, HISTOGRAM_MODE, LOOKUP_MODE]
+# pixels clustered in LOOKUP_MODE
+FIT_SAMPLE_SIZE = 1 << 18
+
+# the argument that asks for a range of k values to be compared
+SWEEP_PROMPT = 'sweep'
+# the k values compared by default
+SWEEP_RANGE = (2, 10)
+# width of each image on the contact sheet
+THUMBNAIL_WIDTH = 400
+
+def flatten(points):
+    '''Turns an H x W x 3 image into an N x 3 float32 array of pixels.'''
+    return points.reshape(-1, points.shape[-1]).astype(np.float32)
+
+def closest_centroids(pixels, centroids, chunk=CHUNK_SIZE):
     '''
-    Given a collection of points and centroids, finds the closest centroids
-    to each point and returns those collections. Note that this is computed 
-    in COLOR SPACE, not actual proximity.
+    Given a collection of pixels and centroids, finds the closest centroid to
+    each pixel. Note that this is computed in COLOR SPACE, not actual 
+    proximity. Returns the index of each pixel's centroid and the squared 
+    distance to it.
     '''
-    # get the sum of the squared differences between each point
-    differences = points - centroids[:, np.newaxis, np.newaxis]
-    squareDifferences = differences**2
-    summedSquaredDifferences = squareDifferences.sum(axis=3)
-    
-    # apply square root to complete euclidean distance formula
-    finalDistances = np.sqrt(summedSquaredDifferences)
-    return np.argmin(finalDistances, axis=0)
+    labels = np.empty(len(pixels), dtype=np.intp)
+    distances = np.empty(len(pixels), dtype=np.float32)
+    # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, and |p|^2 is the same for every c, 
+    # so it doesn't matter when we're only looking for the closest c
+    c_squared = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(pixels), chunk):
+        block = pixels[start:start + chunk]
+        scores = block.dot(centroids.T)
+        scores *= -2
+        scores += c_squared
+        closest = scores.argmin(axis=1)
+        labels[start:start + chunk] = closest
+        distances[start:start + chunk] = scores[np.arange(len(block)), closest] + \
+            (block ** 2).sum(axis=1)
+    return labels, distances
 
-def move_centroids(points, closest, centroids):
+def assign_tile(pixels, centroids, weights, labels, distances, start, stop):
     '''
-    After each iteration, the centroids are adjusted to the center of their
-    constituent points.
+    Assigns the pixels in [start, stop) to their closest centroids, writing
+    the results into labels and distances. Returns the (weighted) per-cluster
+    sums and counts of those pixels.
     '''
-    newCentroids = []
-    for idx in range(centroids.shape[0]):
-        # find which points are in group idx
-        indices = (closest == idx)
-        # get all points that are in group idx
-        correspondingPoints = points[indices]
-        # average rgb values
-        average = correspondingPoints.mean(axis=0)
-        # add to new centroids list
-        newCentroids.append(average)
+    k = len(centroids)
+    tile = pixels[start:stop]
+    tileWeights = weights[start:stop] if weights is not None else None
+    closest, tileDistances = closest_centroids(tile, centroids)
+    labels[start:stop] = closest
+    distances[start:stop] = tileDistances
+
+    counts = np.bincount(closest, weights=tileWeights, minlength=k)
+    if tileWeights is not None:
+        tile = tile * tileWeights[:, np.newaxis]
+    sums = np.stack([np.bincount(closest, weights=tile[:, channel], minlength=k)
+        for channel in range(tile.shape[1])], axis=1)
+    return sums, counts
+
+_pool = None
+_pool_pid = None
+_pool_threads = 0
+_pool_lock = threading.Lock()
+
+def get_pool(threads):
+    '''
+    Lazily creates the threads used for assignment, replacing the pool if
+    more threads are needed. Threads don't survive a fork, so a worker 
+    process makes its own pool instead of using a copy of its parent's.
+    '''
+    global _pool, _pool_pid, _pool_threads
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid() or _pool_threads < threads:
+            if _pool is not None and _pool_pid == os.getpid():
+                # let whatever the old pool is running finish, then let it go
+                _pool.shutdown(wait=False)
+            _pool = ThreadPoolExecutor(max_workers=threads)
+            _pool_pid = os.getpid()
+            _pool_threads = threads
+        return _pool
+
+def assign(pixels, centroids, weights=None, threads=None):
+    '''
+    Assigns every pixel to its closest centroid. The pixels are split into
+    contiguous tiles (i.e. horizontal strips of the image) that are processed
+    on separate threads; numpy releases the GIL in the heavy lifting. Returns
+    each pixel's centroid and squared distance to it, as well as the 
+    per-cluster sums and counts needed to move the centroids.
+    '''
+    threads = threads or const.KMEANS_THREADS
+    labels = np.empty(len(pixels), dtype=np.intp)
+    distances = np.empty(len(pixels), dtype=np.float32)
+    # don't bother splitting up small jobs
+    tiles = max(1, min(threads, len(pixels) // CHUNK_SIZE))
+    bounds = np.linspace(0, len(pixels), tiles + 1).astype(int)
+
+    if tiles == 1:
+        partials = [assign_tile(pixels, centroids, weights, labels, distances, 0, len(pixels))]
+    else:
+        pool = get_pool(threads)
+        partials = list(pool.map(
+            lambda idx: assign_tile(pixels, centroids, weights, labels, distances,
+                bounds[idx], bounds[idx + 1]),
+            range(tiles)))
+
+    sums = sum(partial[0] for partial in partials)
+    counts = sum(partial[1] for partial in partials)
+    return labels, distances, sums, counts
 
-    # Return the resulting centroids.
-    return np.array(newCentroids)
+def move_centroids(pixels, centroids, distances, sums, counts):
+    '''
+    After each iteration, the centroids are adjusted to the (weighted) center
+    of their constituent pixels. A centroid that lost all of its pixels is 
+    moved to the pixel that is currently worst served by its centroid.
+    '''
+    newCentroids = centroids.copy()
+    filled = counts > 0
+    newCentroids[filled] = sums[filled] / counts[filled, np.newaxis]
+
+    empty = np.flatnonzero(~filled)
+    if len(empty):
+        farthest = np.argpartition(distances, -len(empty))[-len(empty):]
+        newCentroids[empty] = pixels[farthest]
+
+    return newCentroids
+
+def initialize_centroids(pixels, k_value, weights=None, sample_size=SAMPLE_SIZE,
+        start=None):
+    '''
+    Chooses k well spread out colors with k-means++ seeding: each new color
+    is drawn with probability proportional to its squared distance from the
+    colors chosen so far (times its weight, if the pixels are weighted). Only
+    a random sample of the pixels is considered, so this costs next to 
+    nothing even for huge images. If some centroids are given to start 
+    with, they are kept, and only the rest are chosen.
+    '''
+    if weights is None:
+        weights = np.ones(len(pixels), dtype=np.float32)
+    if len(pixels) > sample_size:
+        # drawn with replacement: choosing without builds a permutation of
+        # every pixel, which costs more than the seeding it speeds up
+        sample = np.random.randint(len(pixels), size=sample_size)
+        pixels, weights = pixels[sample], weights[sample]
+
+    if start is None or len(start) == 0:
+        start = [pixels[np.random.choice(len(pixels), p=weights / weights.sum())]]
+    centroids = list(start)[:k_value]
+    distances = np.min([((pixels - c) ** 2).sum(axis=1) for c in centroids], axis=0)
+    for _ in range(len(centroids), k_value):
+        odds = distances * weights
+        total = odds.sum()
+        # the image has fewer distinct colors than k; don't repeat any
+        if total <= 0:
+            break
+        choice = pixels[np.random.choice(len(pixels), p=odds / total)]
+        centroids.append(choice)
+        distances = np.minimum(distances, ((pixels - choice) ** 2).sum(axis=1))
+    return np.array(centroids, dtype=np.float32)
+
+def color_codes(points, bits=HISTOGRAM_BITS):
+    '''
+    Quantizes every pixel of a uint8 image to the given number of bits per 
+    channel, and packs the result into a single integer per pixel.
+    '''
+    shift = 8 - bits
+    quantized = points.reshape(-1, 3) >> shift
+    return (quantized[:, 0].astype(np.intp) << (2 * bits)) | \
+        (quantized[:, 1].astype(np.intp) << bits) | quantized[:, 2]
+
+def code_colors(codes, bits=HISTOGRAM_BITS):
+    '''Returns the color at the center of each bin of color_codes().'''
+    mask = (1 << bits) - 1
+    channels = [(codes >> (2 * bits)) & mask, (codes >> bits) & mask, codes & mask]
+    width = 1 << (8 - bits)
+    return (np.stack(channels, axis=1).astype(np.float32) + 0.5) * width
+
+def color_histogram(points, bits=HISTOGRAM_BITS):
+    '''
+    Bins the pixels of an image by color. Returns the code of every pixel, 
+    the codes that occur at all, their colors, and how often each occurs.
+    '''
+    codes = color_codes(points, bits)
+    counts = np.bincount(codes, minlength=1 << (3 * bits))
+    present = np.flatnonzero(counts)
+    return codes, present, code_colors(present, bits), counts[present].astype(np.float32)
 
-def initialize_centroids(points, k_value):
+def build_lookup(centroids, bits=HISTOGRAM_BITS):
     '''
-    Choose a number of random colors from the collection of all colors in 
-    the image.
+    Finds the closest centroid to every bin of color_codes(), so that any
+    pixel can be assigned to a centroid with a single table lookup.
     '''
-    # ensure unique centroids are chosen
-    centroids = np.unique(points.reshape(-1, points.shape[2]), axis=0)
-    np.random.shuffle(centroids)
-    return centroids[:k_value]
+    codes = np.arange(1 << (3 * bits))
+    lookup, _ = closest_centroids(code_colors(codes, bits), centroids)
+    return lookup
 
-def set_to_centroids(points, centroids, closestCentroids):
+def set_to_centroids(centroids, closest, shape):
     '''
-    Once all the points have been assigned a centroid and the maximum 
+    Once all the pixels have been assigned a centroid and the maximum 
     number of iterations has been reached, then it is time to create a new
     image with only the colors of the centroids.
     '''
-    # construct a blank image
-    newPoints = np.zeros(points.shape)
-    (x, y) = closestCentroids.shape
-    
-    # for each point in that image, set it to be the color of the centroid
-    # representing it
-    for i in range(x):
-        for j in range(y):
-            newPoints[i][j] = centroids[closestCentroids[i][j]]
+    palette = np.clip(np.rint(centroids), 0, 255).astype(np.uint8)
+    return palette[closest].reshape(shape)
+
+def fit(pixels, k_value, weights=None, maxIter=MAX_ITER, tol=TOLERANCE, threads=None,
+        start=None):
+    '''
+    Clusters (optionally weighted) pixels. Returns the centroids, the index
+    of each pixel's centroid, and the number of iterations it took to 
+    converge. Clustering can be warm started with a few known centroids.
+    '''
+    # initialize centroids with k-means++
+    centroids = initialize_centroids(pixels, k_value, weights, start=start)
+
+    # kmeans runs until the fit stops improving much (or for at most maxIter
+    # iterations). For each iteration, first the pixels are assigned to a 
+    # centroid, and then the centroids are moved to better reflect the pixels
+    # assigned to them.
+    previous = None
+    for idx in range(1, maxIter + 1):
+        closestCentroids, distances, sums, counts = assign(pixels, centroids, weights, threads)
+        if weights is None:
+            inertia = distances.sum(dtype=np.float64)
+        else:
+            inertia = np.dot(distances, weights.astype(np.float64))
+        centroids = move_centroids(pixels, centroids, distances, sums, counts)
+        if previous is not None and previous - inertia <= tol * previous:
+            break
+        previous = inertia
 
-    return newPoints
+    return centroids, closestCentroids, idx
 
-def k_means(points, k_value, maxIter=10):
+def cluster(points, k_value, mode=FULL_MODE, maxIter=MAX_ITER, tol=TOLERANCE):
     '''
-    Driver for the kmeans algorithm. Applies kmeans to an image and then
-    displays the result.
+    Clusters the colors of an image. Returns the centroids, the index of the
+    centroid of every pixel, and the number of iterations it took to 
+    converge.
+
+    In FULL_MODE, every pixel is clustered. In HISTOGRAM_MODE, the pixels 
+    are first binned by color, and only the distinct colors are clustered, 
+    weighted by how often they occur; each iteration then costs as much as 
+    the number of colors rather than the number of pixels. In LOOKUP_MODE, a
+    random sample of the pixels is clustered, and the full image is colored
+    through a table that maps every color bin to its closest centroid.
     '''
-    # initialize centroids randomly
-    centroids = initialize_centroids(points, k_value)
+    if mode == LOOKUP_MODE:
+        pixels = points.reshape(-1, points.shape[-1])
+        if len(pixels) > FIT_SAMPLE_SIZE:
+            pixels = pixels[np.random.randint(len(pixels), size=FIT_SAMPLE_SIZE)]
+        centroids, _, iterations = fit(pixels.astype(np.float32), k_value,
+            maxIter=maxIter, tol=tol)
+        closestCentroids = build_lookup(centroids)[color_codes(points)]
+    elif mode == HISTOGRAM_MODE:
+        codes, present, colors, counts = color_histogram(points)
+        centroids, colorCentroids, iterations = fit(colors, k_value, counts, maxIter, tol)
+        # every pixel belongs to the centroid of its color
+        lookup = np.zeros(1 << (3 * HISTOGRAM_BITS), dtype=np.intp)
+        lookup[present] = colorCentroids
+        closestCentroids = lookup[codes]
+    else:
+        centroids, closestCentroids, iterations = fit(flatten(points), k_value,
+            maxIter=maxIter, tol=tol)
 
-    # kmeans runs for a number of iterations. For each iteration, first the 
-    # points are assigned to a centroid, and then the centroids are moved
-    # to better reflect the points assigned to them.
-    for idx in range(0, maxIter):
-        # print("Iteration: " + str(idx + 1))
-        closestCentroids = closest_centroids(points, centroids)
-        centroids = move_centroids(points, closestCentroids, centroids)
+    return centroids, closestCentroids, iterations
 
+def encode_palette(centroids, closest, shape):
+    '''
+    Encodes a clustered image as a palette-indexed PNG: one byte per pixel
+    pointing into a table of (at most 256) centroid colors. There is no need
+    to ever build the full color image.
+    '''
+    palette = np.clip(np.rint(centroids[:, ::-1]), 0, 255).astype(np.uint8) # BGR -> RGB
+    indices = Image.fromarray(closest.astype(np.uint8).reshape(shape[:2]), mode='P')
+    indices.putpalette(palette.flatten().tolist())
+    buf = io.BytesIO()
+    indices.save(buf, format='PNG')
+    return buf.getvalue()
+
+def cartoonize(points, k_value, mode=FULL_MODE):
+    '''
+    Applies kmeans to an image and returns the result as an encoded PNG, 
+    along with the number of iterations it took to converge.
+    '''
+    centroids, closest, iterations = cluster(points, k_value, mode)
+    return encode_palette(centroids, closest, points.shape), iterations
+
+def sweep(points, k_values, thumbnail_width=THUMBNAIL_WIDTH):
+    '''
+    Clusters an image for several values of k and returns a contact sheet of 
+    the results, encoded as a PNG. The color histogram is built only once, 
+    and every k starts from the centroids found for the one before it, so the
+    whole sweep costs little more than clustering with the largest k.
+    '''
+    _, present, colors, counts = color_histogram(points)
+    # the results are shown small, so only color a thumbnail of the image
+    step = max(1, -(-points.shape[1] // thumbnail_width))
+    thumbnail = points[::step, ::step]
+    codes = color_codes(thumbnail)
+
+    tiles, captions, centroids = [], [], None
+    for k_value in sorted(k_values):
+        centroids, _, iterations = fit(colors, k_value, counts, start=centroids)
+        closest = build_lookup(centroids)[codes]
+        tiles.append(set_to_centroids(centroids, closest, thumbnail.shape))
+        captions.append('k: %d (%d iterations)' % (k_value, iterations))
+    return image.encode(image.contact_sheet(tiles, captions))
+
+def k_means(points, k_value, mode=FULL_MODE, maxIter=MAX_ITER, tol=TOLERANCE):
+    '''
+    Driver for the kmeans algorithm. Applies kmeans to an image and returns
+    the result, along with the number of iterations it took to converge.
+    '''
+    centroids, closest, iterations = cluster(points, k_value, mode, maxIter, tol)
     # Get the final, cartoonized image.
-    finalPoints = set_to_centroids(points, centroids, closestCentroids)
-    return finalPoints
+    return set_to_centroids(centroids, closest, points.shape), iterations
 
 class SkillKmeans(skill.Skill):
+
+    cpu_bound = True
     
     def __init__(self):
         super().__init__()
 
-    def help(self):
-        self.respond(
+    def help(self, ctx):
+        self.respond(ctx,
             'usage:\n' +\
-                '\t@ritai kmeans [k_value] <image>\n' +\
+                '\t@ritai kmeans [k_value] [mode] <image>\n' +\
                 '\t\tI will perform k-means color simplification on the attached image.\n' +\
+                '\tNOTE: mode can be one of:\n' +\
+                '\t\tfull: cluster every pixel (default)\n' +\
+                '\t\thist: cluster the distinct colors of the image, which is faster\n' +\
+                '\t\tfast: cluster a sample of the pixels, which is fastest\n' +\
+                '\t@ritai kmeans sweep [low-high] <image>\n' +\
+                '\t\tI will show the results for every k value in a range (default 2-10).\n' +\
                 '\tNOTE: k_value must be in range [1-10].\n' +\
                 '\tNOTE: If k_value is not an integer, I will choose one randomly.\n'
         )
     
-    def execute(self, prompt):
+    def cache_key(self, ctx):
+        '''Only remember results for which the user chose the k value.'''
+        if not any(arg.isdigit() or arg == SWEEP_PROMPT for arg in ctx.args[1:]):
+            return None
+        return super().cache_key(ctx)
+
+    def execute(self, ctx):
         '''
         Performs k-means clustering over a given image input (color simplification)
 
@@ -119,23 +392,34 @@ class SkillKmeans(skill.Skill):
         If a k value was provided, it uses that k value. Otherwise, it choses
         a random one.
         '''
-        prompt_list = prompt.split(' ')
+        prompt_list = ctx.args
         k_value = None
+        mode = FULL_MODE
+
+        if len(prompt_list) > 1 and prompt_list[1].lower() == SWEEP_PROMPT:
+            self.sweep(ctx)
+            return
         
-        # was an k value provided?
-        if len(prompt_list) > 1:
-            k_value = prompt_list[1]
         # warn the user if too many arguments were provided
-        if len(prompt_list) > 2:
-            self.respond('Invalid numer of arguments: %d' % len(prompt_list))
+        if len(prompt_list) > 3:
+            self.respond(ctx, 'Invalid numer of arguments: %d' % len(prompt_list))
             return
+        # was a k value or a mode provided?
+        for arg in prompt_list[1:]:
+            if arg.lower() in MODES:
+                mode = arg.lower()
+            elif k_value is None:
+                k_value = arg
+            else:
+                self.respond(ctx, 'I don\'t recognize the mode %s. Try @ritai help kmeans.' % arg)
+                return
 
         # validate k_value
         if k_value:
             try:
                 k_value = int(k_value)
                 if not (0 < k_value < 11):
-                    self.respond('K value must be between 1 and 10 inclusive.')
+                    self.respond(ctx, 'K value must be between 1 and 10 inclusive.')
                     return
             except ValueError:
                 k_value = None
@@ -145,11 +429,34 @@ class SkillKmeans(skill.Skill):
             if k_value > 10: k_value = 10
 
         # perform kMeans
-        img = self.read_image()
-        output = k_means(img, k_value)
-        self.write_image(output)
+        img = self.read_image(ctx)
+        output, iterations = self.offload(cartoonize, img, k_value, mode)
+        ctx.image.set_output(output)
         
-        self.upload_image(('k: %d' % k_value))
+        self.upload_image(ctx, ('k: %d (%d iterations)' % (k_value, iterations)))
+
+    def sweep(self, ctx):
+        '''Compares the results of a range of k values side by side.'''
+        prompt_list = ctx.args
+        low, high = SWEEP_RANGE
+        if len(prompt_list) > 3:
+            self.respond(ctx, 'Invalid numer of arguments: %d' % len(prompt_list))
+            return
+        if len(prompt_list) == 3:
+            try:
+                low, high = (int(bound) for bound in prompt_list[2].split('-'))
+            except ValueError:
+                self.respond(ctx, 'The range should look like 2-10.')
+                return
+            if not (0 < low <= high < 11):
+                self.respond(ctx, 'K values must be between 1 and 10 inclusive.')
+                return
+
+        img = self.read_image(ctx)
+        output = self.offload(sweep, img, range(low, high + 1))
+        ctx.image.set_output(output)
+
+        self.upload_image(ctx, ('k: %d-%d' % (low, high)))
 
 def main():
     # get input
@@ -158,7 +465,7 @@ def main():
     k_value = int(input("Please enter k: ")) # number of groups
 
     # copy points and save them
-    newPoints = k_means(points, k_value)
+    newPoints, _ = k_means(points, k_value)
 
     # same new pixels to new image
     misc.imsave("outfile.jpg", newPoints)
@@ -5,13 +5,15 @@ Code source:
 
 import os
 import gzip
+import struct
 import numpy as np
 
 DATA_URL = 'http://yann.lecun.com/exdb/mnist/'
 
 # Download and import the MNIST dataset from Yann LeCun's website.
 # Reserve 10,000 examples from the training set for validation.
-# Each image is an array of 784 (28x28) float values  from 0 (white) to 1 (black).
+# Images are memory-mapped arrays of 784 (28x28) uint8 values from 0 (white) to
+# 255 (black); pass batches of them through normalize() before use.
 def load_data(one_hot=True, reshape=None, validation_size=10000):
     x_tr = load_images('train-images-idx3-ubyte.gz')
     y_tr = load_labels('train-labels-idx1-ubyte.gz')
@@ -30,16 +32,36 @@ def load_data(one_hot=True, reshape=None, validation_size=10000):
     return x_tr, y_tr, x_te, y_te
 
 def load_images(filename):
-    maybe_download(filename)
-    with gzip.open(filename, 'rb') as f:
-        data = np.frombuffer(f.read(), np.uint8, offset=16)
-    return data.reshape(-1, 28 * 28) / np.float32(256)
+    data = load_idx(filename)
+    return data.reshape(-1, 28 * 28)
 
 def load_labels(filename):
-    maybe_download(filename)
-    with gzip.open(filename, 'rb') as f:
-        data = np.frombuffer(f.read(), np.uint8, offset=8)
-    return data
+    return load_idx(filename)
+
+# Scale a batch of images to float32 values in [0, 1).
+def normalize(images, out=None):
+    return np.multiply(images, np.float32(1 / 256), out=out, dtype=np.float32)
+
+# Memory-map an IDX file, decompressing it once on first use. The uncompressed
+# file keeps its IDX header, which tells us the shape of the data.
+def load_idx(filename):
+    raw = filename[:-len('.gz')] if filename.endswith('.gz') else filename
+    if not os.path.exists(raw):
+        maybe_download(filename)
+        with gzip.open(filename, 'rb') as src, open(raw + '.tmp', 'wb') as dst:
+            while True:
+                chunk = src.read(1 << 20)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        os.replace(raw + '.tmp', raw)
+
+    with open(raw, 'rb') as f:
+        zero, dtype, ndim = struct.unpack('>HBB', f.read(4))
+        if zero != 0 or dtype != 0x08:
+            raise ValueError('%s is not an unsigned byte IDX file' % raw)
+        shape = struct.unpack('>' + 'I' * ndim, f.read(4 * ndim))
+    return np.memmap(raw, dtype=np.uint8, mode='r', offset=4 + 4 * ndim, shape=shape)
 
 # Download the file, unless it's already here.
 def maybe_download(filename):
@@ -50,4 +72,4 @@ def maybe_download(filename):
 
 # Convert class labels from scalars to one-hot vectors.
 def to_one_hot(labels, num_classes=10):
-    return np.eye(num_classes)[labels]
+    return np.eye(num_classes, dtype=np.float32)[labels]
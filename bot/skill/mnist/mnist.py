@@ -5,7 +5,9 @@ Adapted from: https://jrusev.github.io/post/hacking-mnist/
 # standard lib
 import os
 import sys
+import time
 import pickle
+import shutil
 
 # required lib
 import cv2
@@ -21,31 +23,84 @@ def feed_forward(X, weights):
         a.append(np.maximum(a[-1].dot(w),0))
     return a
 
-def grads(X, Y, weights):
-    grads = np.empty_like(weights)
-    a = feed_forward(X, weights)
-    delta = a[-1] - Y
-    grads[-1] = a[-2].T.dot(delta)
-    for i in range(len(a)-2, 0, -1):
-        delta = (a[i] > 0) * delta.dot(weights[i].T)
-        grads[i-1] = a[i-1].T.dot(delta)
-    return grads / len(X)
-
-def query(img):
-    # gets "true" location of image, regardless of from where the script is
-    # being run
-    loc = os.path.realpath(
-            os.path.join(os.getcwd(), 
-            os.path.dirname(__file__))
-        )
-    path = os.path.join(loc, 'model.pkl')
-
-    if os.path.isfile(path):
-        with open(path, 'rb') as model:
-            weights = pickle.load(model)
-    else:
-        raise Exception('Cannot query without existing model!')
-
+# gets "true" location of the model, regardless of from where the script is
+# being run
+LOC = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+# one .npy file per layer, which can be memory-mapped so that every process 
+# running the bot shares a single copy of the weights
+MODEL_DIR = os.path.join(LOC, 'model')
+# names the folder inside MODEL_DIR that holds the current model's layers
+CURRENT_NAME = 'CURRENT'
+# the format models used to be saved in, converted on first load
+LEGACY_PATH = os.path.join(LOC, 'model.pkl')
+# digits shorter than this fraction of the image are assumed to be noise
+MIN_DIGIT_HEIGHT = 0.02
+# the argument that asks for every digit in the image to be read
+MANY_PROMPT = 'digits'
+
+def export_model(weights, path=MODEL_DIR):
+    '''
+    Saves each layer as its own .npy file, in a new folder inside path. Once
+    every layer is written, the CURRENT file is pointed at the new folder
+    with a single rename, so neither a crash nor a concurrent reader can mix
+    up layers from two different models. Older folders, apart from the one
+    just replaced, are then removed.
+    '''
+    os.makedirs(path, exist_ok=True)
+    pointer = os.path.join(path, CURRENT_NAME)
+    previous = read_pointer(pointer)
+    version = '%d.%d' % (time.time_ns(), os.getpid())
+    folder = os.path.join(path, version)
+    os.makedirs(folder)
+    for idx, w in enumerate(weights):
+        np.save(os.path.join(folder, 'layer%d.npy' % idx),
+            np.ascontiguousarray(w, dtype=np.float32))
+
+    tmp = '%s.%d.tmp' % (pointer, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, pointer)
+
+    # a reader may still be loading the model we just replaced
+    for name in os.listdir(path):
+        if name not in (version, previous) and os.path.isdir(os.path.join(path, name)):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+def read_pointer(pointer):
+    '''The folder a CURRENT file points at, or None if there isn't one.'''
+    try:
+        with open(pointer) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def load_model(path=MODEL_DIR):
+    '''
+    Memory-maps the layers of a saved model. A model in the legacy pickle 
+    format is converted first.
+    '''
+    if not os.path.isdir(path):
+        if not os.path.isfile(LEGACY_PATH):
+            raise Exception('Cannot query without existing model!')
+        with open(LEGACY_PATH, 'rb') as model:
+            export_model(list(pickle.load(model)), path)
+
+    # models saved before CURRENT existed keep their layers in path itself
+    version = read_pointer(os.path.join(path, CURRENT_NAME))
+    if version:
+        path = os.path.join(path, version)
+
+    layers = sorted(
+        (f for f in os.listdir(path) if f.startswith('layer') and f.endswith('.npy')),
+        key=lambda f: int(f[len('layer'):-len('.npy')])
+    )
+    if not layers:
+        raise Exception('No layers found in %s!' % path)
+    if layers != ['layer%d.npy' % idx for idx in range(len(layers))]:
+        raise Exception('Some layers are missing from %s!' % path)
+    return [np.load(os.path.join(path, f), mmap_mode='r') for f in layers]
+
+def query(img, weights):
     img_smol = cv2.resize(img, (28, 28))
 
     img_lin = np.resize(img_smol, [1, 784])
@@ -54,64 +109,111 @@ def query(img):
     
     return prediction[0]
 
-def train():
-    import load_data
-    trX, trY, teX, teY = load_data.load_data()
-    num_epochs, batch_size, learn_rate = 30, 20, 0.1
-
-    if os.path.isfile('model.pkl'):
-        print('Loading model...')
-        with open('model.pkl', 'rb') as model:
-            weights = pickle.load(model)
-    else:
-        print('Generating model...')
-        weights = [np.random.randn(*w) * 0.1 for w in [(784, 100), (100, 10)]]
-    
-    print('...done.')
+def reading_order(boxes):
+    '''
+    Sorts bounding boxes (x, y, w, h) the way we'd read them: line by line, 
+    from top to bottom, then from left to right within each line.
+    '''
+    lines = [] # [top, bottom, boxes]
+    for box in sorted(boxes, key=lambda box: box[1]):
+        center = box[1] + box[3] / 2
+        for line in lines:
+            if line[0] <= center <= line[1]:
+                line[1] = max(line[1], box[1] + box[3])
+                line[2].append(box)
+                break
+        else:
+            lines.append([box[1], box[1] + box[3], [box]])
+    return [box for line in lines for box in sorted(line[2], key=lambda box: box[0])]
+
+def segment_digits(img):
+    '''
+    Finds the digits in a picture of dark writing on a light background. 
+    Returns them as an (N, 784) batch in reading order, each one drawn the way
+    MNIST digits are: light on dark, scaled to fit a 20x20 box in the middle 
+    of a 28x28 image.
+    '''
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+
+    # ignore the background (label 0) and specks too small to be a digit
+    min_height = img.shape[0] * MIN_DIGIT_HEIGHT
+    boxes = [tuple(stats[idx, :4]) + (idx,) for idx in range(1, count)
+        if stats[idx, cv2.CC_STAT_HEIGHT] >= min_height]
+    boxes = reading_order(boxes)
+
+    batch = np.zeros((len(boxes), 28, 28), dtype=np.float32)
+    for idx, (x, y, w, h, label) in enumerate(boxes):
+        # only keep this component, not bits of its neighbors
+        digit = (labels[y:y+h, x:x+w] == label).astype(np.float32)
+        scale = 20 / max(w, h)
+        sw, sh = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+        digit = cv2.resize(digit, (sw, sh), interpolation=cv2.INTER_AREA)
+        top, left = (28 - sh) // 2, (28 - sw) // 2
+        batch[idx, top:top+sh, left:left+sw] = digit
+    return batch.reshape(-1, 784)
+
+def query_many(img, weights):
+    '''
+    Reads every digit in an image. All of them are classified together, with
+    a single matrix multiplication per layer.
+    '''
+    batch = segment_digits(img)
+    if len(batch) == 0:
+        return []
+    return list(np.argmax(feed_forward(batch, weights)[-1], axis=1))
 
-    for i in range(num_epochs):
-        for j in range(0, len(trX), batch_size):
-            X, Y = trX[j:j+batch_size], trY[j:j+batch_size]
-            weights -= learn_rate * grads(X, Y, weights)
-        
-        prediction = np.argmax(feed_forward(teX, weights)[-1], axis=1)
-        print(i, np.mean(prediction == np.argmax(teY, axis=1)))
-
-        with open('model.pkl', 'wb') as model:
-            pickle.dump(weights, model)
-            
 class SkillMnist(skill.Skill):
     
     def __init__(self):
+        # loaded once by warmup() and kept for every prompt after that
+        self.weights = None
         super().__init__()
     
-    def help(self):
-        self.respond(    
+    def warmup(self):
+        self.weights = load_model()
+
+    def help(self, ctx):
+        self.respond(ctx,
             'usage:\n' +\
                 '\t@ritai mnist <image>\n' +\
-                '\t\tAttach an image and I will guess what number it is!\n'
+                '\t\tAttach an image and I will guess what number it is!\n' +\
+                '\t@ritai mnist digits <image>\n' +\
+                '\t\tI will read every digit in the image (e.g. a phone number).\n'
         )
     
-    def execute(self, prompt):
+    def execute(self, ctx):
         '''
         Uses a rudimentary neural net to guess which number is in an image.
         '''
-        prompt_list = prompt.split(' ')
+        prompt_list = ctx.args
         
         # warn user if they entered too many arguments
-        if len(prompt_list) > 1:
-            self.respond('Invalid number of arguments: %d' % len(prompt_list))
+        if len(prompt_list) > 2 or (len(prompt_list) == 2 and prompt_list[1] != MANY_PROMPT):
+            self.respond(ctx, 'Invalid number of arguments: %d' % len(prompt_list))
             return
         
+        img = self.read_image(ctx)
+
+        # read all of the digits
+        if len(prompt_list) == 2:
+            digits = query_many(img, self.weights)
+            if digits:
+                self.respond(ctx, 'I think this says... %s.' % ''.join(str(d) for d in digits))
+            else:
+                self.respond(ctx, 'I couldn\'t find any digits in that image.')
+            return
+
         # perform mnist
-        img = self.read_image()
-        prediction = query(img)
+        prediction = query(img, self.weights)
 
         # report prediction
-        self.respond('I think this is a... %d.' % prediction)
+        self.respond(ctx, 'I think this is a... %d.' % prediction)
 
 def main():
-    train()
+    from . import trainer
+    trainer.main()
 
 if __name__ == '__main__':
     main()
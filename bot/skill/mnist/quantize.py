@@ -0,0 +1,82 @@
+"""
+Int8 quantization of the network used by the mnist skill. Each layer's weights
+are stored as int8 with one float scale per output column; activations are
+quantized per row on the fly, and every matrix product accumulates in int32.
+
+Compare accuracy and latency against the float model with:
+
+    python -m bot.skill.mnist.quantize
+
+This is an experiment, not something the bot uses: numpy's integer matmul
+isn't backed by BLAS, so the int8 model is much slower than the float one.
+On one core (numpy 2.4), with the saved model:
+
+    model    batch (ms)   single (us)
+    float32       23.41          10.4
+    int8         708.81          99.0
+
+A batch is 10,000 images. Accuracy on the test set wasn't measured alongside
+these timings.
+"""
+
+# standard lib
+import time
+
+# required lib
+import numpy as np
+
+# project lib
+from . import mnist
+from . import load_data
+
+def quantize(weights):
+    '''Turns float layers into (int8 weights, per-column scale) pairs.'''
+    qweights = []
+    for w in weights:
+        w = np.asarray(w, dtype=np.float32)
+        scale = np.abs(w).max(axis=0) / 127
+        scale[scale == 0] = 1
+        q = np.clip(np.rint(w / scale), -127, 127).astype(np.int8)
+        qweights.append((q, scale.astype(np.float32)))
+    return qweights
+
+def quantize_rows(X):
+    '''Quantizes each row of a matrix to int8, returning the row scales too.'''
+    X = np.asarray(X, dtype=np.float32)
+    scale = np.abs(X).max(axis=1, keepdims=True) / 127
+    scale[scale == 0] = 1
+    return np.clip(np.rint(X / scale), -127, 127).astype(np.int8), scale
+
+def feed_forward_int8(X, qweights):
+    '''Works like mnist.feed_forward, but on quantized layers.'''
+    a = [X]
+    for q, w_scale in qweights:
+        xq, x_scale = quantize_rows(a[-1])
+        acc = np.matmul(xq, q, dtype=np.int32)
+        a.append(np.maximum(acc * x_scale * w_scale, 0))
+    return a
+
+def benchmark(forward, weights, X, Y, repeat=5):
+    '''Returns the accuracy of a model and its best time (s) to classify X.'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        prediction = np.argmax(forward(X, weights)[-1], axis=1)
+        best = min(best, time.perf_counter() - start)
+    return np.mean(prediction == Y), best
+
+def main():
+    X = load_data.normalize(load_data.load_images('t10k-images-idx3-ubyte.gz'))
+    Y = np.asarray(load_data.load_labels('t10k-labels-idx1-ubyte.gz'))
+    weights = [np.array(w, dtype=np.float32) for w in mnist.load_model()]
+    qweights = quantize(weights)
+
+    print('%-8s %9s %12s %14s' % ('model', 'accuracy', 'batch (ms)', 'single (us)'))
+    for name, forward, w in [('float32', mnist.feed_forward, weights),
+            ('int8', feed_forward_int8, qweights)]:
+        accuracy, batch = benchmark(forward, w, X, Y)
+        _, single = benchmark(forward, w, X[:1], Y[:1], repeat=100)
+        print('%-8s %9.4f %12.2f %14.1f' % (name, accuracy, batch * 1e3, single * 1e6))
+
+if __name__ == '__main__':
+    main()
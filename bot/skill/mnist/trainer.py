@@ -0,0 +1,183 @@
+"""
+Trains the network used by the mnist skill.
+
+    python -m bot.skill.mnist.trainer --batch-size 64 --threads 4
+"""
+
+# standard lib
+import os
+import time
+import argparse
+import contextlib
+
+# required lib
+import numpy as np
+
+# project lib
+from . import mnist
+from . import load_data
+
+# the layers of a freshly generated model
+LAYERS = [(784, 100), (100, 10)]
+
+def parse_args():
+    '''construct the argument parser and parse the arguments'''
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--epochs', type=int, default=30,
+        help='most passes to make over the training set')
+    ap.add_argument('--batch-size', type=int, default=64,
+        help='samples per gradient step')
+    ap.add_argument('--learn-rate', type=float, default=0.1,
+        help='step size of gradient descent')
+    ap.add_argument('--patience', type=int, default=3,
+        help='epochs without a better validation accuracy before stopping')
+    ap.add_argument('--threads', type=int, default=None,
+        help='threads used for matrix math (default: all of them)')
+    ap.add_argument('--fresh', action='store_true',
+        help='start from random weights instead of the saved model')
+    return ap.parse_args()
+
+def limit_threads(threads):
+    '''
+    Returns a context manager that caps the threads numpy uses for matrix 
+    math while it is active.
+    '''
+    if threads:
+        try:
+            from threadpoolctl import threadpool_limits
+            return threadpool_limits(limits=threads)
+        except ImportError:
+            print('threadpoolctl is not installed; set OMP_NUM_THREADS instead.')
+    return contextlib.suppress()
+
+class Trainer():
+    '''
+    Trains the network with minibatch gradient descent. Every buffer used in
+    a training step is allocated up front, in float32, and reused for every
+    step; the weights are updated in place.
+    '''
+
+    def __init__(self, weights, batch_size=64, learn_rate=0.1):
+        self.weights = [np.array(w, dtype=np.float32) for w in weights]
+        self.batch_size = batch_size
+        self.learn_rate = learn_rate
+
+        sizes = [self.weights[0].shape[0]] + [w.shape[1] for w in self.weights]
+        # the raw pixels of a batch, gathered from the (uint8) dataset
+        self.pixels = np.empty((batch_size, sizes[0]), dtype=np.uint8)
+        # one-hot labels of a batch
+        self.targets = np.empty((batch_size, sizes[-1]), dtype=np.float32)
+        # activations of each layer; the first one is the input
+        self.acts = [np.empty((batch_size, size), dtype=np.float32) for size in sizes]
+        # error signal at the output of each layer
+        self.deltas = [np.empty((batch_size, size), dtype=np.float32) for size in sizes[1:]]
+        self.grads = [np.empty_like(w) for w in self.weights]
+
+    def batches(self, images, labels, rng):
+        '''
+        Visits the dataset in a random order, one batch at a time. Nothing is
+        copied except the batch itself, into the preallocated buffers. Yields
+        the number of samples in each batch.
+        '''
+        order = rng.permutation(len(images))
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            n = len(idx)
+            np.take(images, idx, axis=0, out=self.pixels[:n])
+            load_data.normalize(self.pixels[:n], out=self.acts[0][:n])
+            self.targets[:n] = 0
+            self.targets[np.arange(n), labels[idx]] = 1
+            yield n
+
+    def step(self, n):
+        '''Takes one gradient step on the first n samples in the buffers.'''
+        acts = [a[:n] for a in self.acts]
+        deltas = [d[:n] for d in self.deltas]
+
+        # forward pass
+        for i, w in enumerate(self.weights):
+            np.dot(acts[i], w, out=acts[i + 1])
+            np.maximum(acts[i + 1], 0, out=acts[i + 1])
+
+        # backward pass
+        np.subtract(acts[-1], self.targets[:n], out=deltas[-1])
+        np.dot(acts[-2].T, deltas[-1], out=self.grads[-1])
+        for i in range(len(self.weights) - 1, 0, -1):
+            np.dot(deltas[i], self.weights[i].T, out=deltas[i - 1])
+            deltas[i - 1][acts[i] <= 0] = 0
+            np.dot(acts[i - 1].T, deltas[i - 1], out=self.grads[i - 1])
+
+        # update
+        for w, g in zip(self.weights, self.grads):
+            g *= self.learn_rate / n
+            w -= g
+
+    def accuracy(self, images, labels, chunk=10000):
+        '''Fraction of images whose label the network predicts correctly.'''
+        correct = 0
+        for start in range(0, len(images), chunk):
+            X = load_data.normalize(images[start:start + chunk])
+            prediction = np.argmax(mnist.feed_forward(X, self.weights)[-1], axis=1)
+            correct += np.count_nonzero(prediction == labels[start:start + chunk])
+        return correct / len(images)
+
+    def fit(self, train, validation, epochs=30, patience=3, seed=None,
+            checkpoint=None):
+        '''
+        Trains until the validation accuracy hasn't improved for patience
+        epochs (or epochs run out), then restores the best weights seen. Each
+        time the validation accuracy improves, checkpoint(weights) is called.
+        '''
+        rng = np.random.RandomState(seed)
+        best, best_weights, stale = -1, None, 0
+        for epoch in range(epochs):
+            start = time.perf_counter()
+            for n in self.batches(*train, rng):
+                self.step(n)
+            elapsed = time.perf_counter() - start
+
+            score = self.accuracy(*validation)
+            print('epoch %d: validation accuracy %.4f, %.0f samples/s' %
+                (epoch, score, len(train[0]) / elapsed))
+
+            if score > best:
+                best, stale = score, 0
+                best_weights = [w.copy() for w in self.weights]
+                if checkpoint:
+                    checkpoint(best_weights)
+            else:
+                stale += 1
+                if stale >= patience:
+                    print('No improvement in %d epochs, stopping.' % patience)
+                    break
+
+        if best_weights is not None:
+            self.weights = best_weights
+        return best
+
+def main():
+    args = parse_args()
+
+    # the last 10,000 training images are held out for validation
+    images = load_data.load_images('train-images-idx3-ubyte.gz')
+    labels = load_data.load_labels('train-labels-idx1-ubyte.gz')
+    train = images[:-10000], labels[:-10000]
+    validation = images[-10000:], labels[-10000:]
+    test = (load_data.load_images('t10k-images-idx3-ubyte.gz'),
+        load_data.load_labels('t10k-labels-idx1-ubyte.gz'))
+
+    if not args.fresh and (os.path.isdir(mnist.MODEL_DIR) or os.path.isfile(mnist.LEGACY_PATH)):
+        print('Loading model...')
+        weights = mnist.load_model()
+    else:
+        print('Generating model...')
+        weights = [np.random.randn(*shape) * 0.1 for shape in LAYERS]
+
+    trainer = Trainer(weights, batch_size=args.batch_size, learn_rate=args.learn_rate)
+    with limit_threads(args.threads):
+        trainer.fit(train, validation, epochs=args.epochs, patience=args.patience,
+            checkpoint=mnist.export_model)
+        print('test accuracy: %.4f' % trainer.accuracy(*test))
+
+if __name__ == '__main__':
+    main()
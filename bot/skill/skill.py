@@ -4,14 +4,12 @@
 # skills
 
 # standard lib
-import os
+import io
 import abc # Abstract Base Class
 
-# required lib
-import cv2
-
 # project lib
 from .. import const
+from .. import engine
 
 class Skill(abc.ABC):
     '''
@@ -20,65 +18,98 @@ class Skill(abc.ABC):
     over multiple files, causing import/dependency headaches. Every function
     below is one that most bot skills will find plenty useful.
     '''
+
+    # skills that spend most of their time crunching numbers (rather than
+    # waiting on the network) should set this, so their heavy lifting is moved
+    # off of the bot's worker threads and into separate processes
+    cpu_bound = False
+    # skills whose replies depend only on their arguments and image can have
+    # those replies remembered and replayed; skills that roll dice should not
+    memoize = True
     
     def __init__(self):
         super().__init__()        
     
-    def set_info(self, info):
+    def warmup(self):
         '''
-        Grabs response data for the current prompt, so that the same Skill 
-        object can be reused.
+        Loads whatever the skill needs (e.g. models) ahead of the first prompt.
+        This is called once, in the background, as the bot starts up.
         '''
-        # the slack client, which the bot uses to respond
-        self.client = info[const.INFO_CLIENT]
-        # the channel in which we are participating
-        self.channel = info[const.INFO_CHANNEL]
-        # the particular thread we were created to respond to
-        self.thread = info[const.INFO_THREAD]
+        pass
     
-    def respond(self, message):
-        '''Has the bot post a message.'''
-        self.client.api_call(
+    def respond(self, ctx, message):
+        '''Has the bot post a message in reply to a prompt.'''
+        ctx.replies.append(('text', message))
+        ctx.client.api_call(
             method='chat.postMessage',
-            channel=self.channel,
+            channel=ctx.channel,
             text=message,
-            thread_ts=self.thread
+            thread_ts=ctx.thread
         )
     
-    def upload_image(self, comment=''):
-        '''Has the bot post an image.'''
-        with open(str(const.TEMP_PATH / const.OUT_IMG_NAME), 'rb') as img:
-            self.client.api_call(
-                method='files.upload',
-                channels=[self.channel],
-                filename=const.OUT_IMG_NAME,
-                title='output',
-                initial_comment=comment,
-                file=img,
-                thread_ts=self.thread
-            )
+    def upload_image(self, ctx, comment=''):
+        '''Has the bot post the image that was produced for a prompt.'''
+        ctx.replies.append(('image', ctx.image.output, comment))
+        ctx.client.api_call(
+            method='files.upload',
+            channels=[ctx.channel],
+            filename=const.OUT_IMG_NAME,
+            title='output',
+            initial_comment=comment,
+            file=io.BytesIO(ctx.image.output),
+            thread_ts=ctx.thread
+        )
             
-    def read_image(self, fname=const.IN_IMG_NAME):
+    def cache_key(self, ctx):
         '''
-        Reads in an image. If the image is not present, it returns a default image.
+        Identifies the result of a prompt, so that it can be remembered. 
+        Returns None if the result shouldn't be remembered.
         '''
-        img = cv2.imread(str(const.TEMP_PATH / const.IN_IMG_NAME))
-        if img is None: # invalid image paths yield None
-            img = cv2.imread(str(const.DEFAULT_PATH / const.DEFAULT_IMG_NAME))    
-        if img is None: # if image is still none, there's a real problem
-            raise Exception('Default image is missing in read_image(): {path}'.format(path=const.DEFAULT_PATH / const.DEFAULT_IMG_NAME))
-        
-        return img
-        
-    def write_image(self, image, fname=const.OUT_IMG_NAME):
-        '''Writes an image to the temp folder'''
-        if not os.path.isdir((const.TEMP_PATH)):
-            os.makedirs(str(const.TEMP_PATH))
+        if not self.memoize:
+            return None
+        args = tuple(arg.lower() for arg in ctx.args if arg)
+        return args + (ctx.image.key() or const.DEFAULT_IMG_NAME,)
+
+    def replay(self, ctx, replies):
+        '''Sends replies that were recorded while answering another prompt.'''
+        for reply in replies:
+            if reply[0] == 'image':
+                ctx.image.output = reply[1]
+                self.upload_image(ctx, reply[2])
+            else:
+                self.respond(ctx, reply[1])
+
+    def offload(self, fn, *args, **kwargs):
+        '''
+        Runs a heavy computation, in a separate process if this skill is CPU 
+        bound. fn must be a module-level function.
+        '''
+        if self.cpu_bound:
+            return engine.offload(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+
+    def offload_map(self, fn, *iterables):
+        '''
+        Runs a heavy computation once per set of arguments, in parallel 
+        processes if this skill is CPU bound. Returns the results in order.
+        '''
+        if self.cpu_bound:
+            return engine.offload_map(fn, *iterables)
+        return list(map(fn, *iterables))
+            
+    def read_image(self, ctx):
+        '''
+        Reads in the image attached to a prompt. If no image is present, it 
+        returns a default image.
+        '''
+        return ctx.image.decode()
         
-        cv2.imwrite(str(const.TEMP_PATH / fname), image)
+    def write_image(self, ctx, image):
+        '''Encodes an image so that it can be uploaded'''
+        ctx.image.encode(image)
     
     @abc.abstractmethod
-    def help(self):
+    def help(self, ctx):
         '''
         The help() method should provide the user a basic understanding of how 
         to invoke the bot's Skill.
@@ -86,9 +117,11 @@ class Skill(abc.ABC):
         pass
         
     @abc.abstractmethod
-    def execute(self, prompt):
+    def execute(self, ctx):
         '''
         Execute is the bulk of the skill; it's what makes the bot actually 
-        perform computations and generate results based on input.
+        perform computations and generate results based on input. Everything
+        about the prompt being answered lives in ctx, never on the skill, so 
+        that one skill can answer many prompts at once.
         '''
         pass
\ No newline at end of file
@@ -10,15 +10,101 @@ import random
 import time
 #import pdb
 import os
+import threading
+import contextlib
+from collections import OrderedDict
 
 # required lib
 import imageio
-import imutils
+import numpy as np
 import cv2
 
 # project lib
+from ... import const
 
 MODEL_DIR = 'bot/skill/stylize/models/'
+# the mean BGR color subtracted from images before they enter the network
+MEAN = (103.939, 116.779, 123.680)
+
+FAST_MODE = 'fast'
+FULL_MODE = 'full'
+MODES = [FAST_MODE, FULL_MODE]
+
+class NetPool():
+    '''
+    Keeps loaded style transfer networks around, so each .t7 file is parsed 
+    once rather than on every request. A net is only ever lent to one caller
+    at a time, so concurrent requests never share a net mid-forward; a style
+    in demand by several callers at once simply gets several nets. Idle nets
+    are evicted, least recently used first, to keep the pool within its 
+    memory budget (estimated from the size of the .t7 files).
+    '''
+
+    def __init__(self, budget=const.STYLIZE_NET_BUDGET):
+        self.budget = budget
+        self.used = 0
+        # checkpoint -> nets that aren't lent out, least recently used first
+        self.idle = OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, ckpt):
+        '''Lends out a net for the given checkpoint, loading one if needed.'''
+        with self.lock:
+            if self.idle.get(ckpt):
+                self.idle.move_to_end(ckpt)
+                return self.idle[ckpt].pop()
+
+        # load the neural style transfer model from disk
+        net = cv2.dnn.readNetFromTorch(ckpt)
+        with self.lock:
+            self.sizes[ckpt] = os.path.getsize(ckpt)
+            self.used += self.sizes[ckpt]
+            self._evict()
+        return net
+
+    def release(self, ckpt, net):
+        '''Returns a net to the pool once the caller is done with it.'''
+        with self.lock:
+            self.idle.setdefault(ckpt, []).append(net)
+            self.idle.move_to_end(ckpt)
+            self._evict()
+
+    @contextlib.contextmanager
+    def net(self, ckpt):
+        '''Borrows a net for the duration of a with block.'''
+        net = self.acquire(ckpt)
+        try:
+            yield net
+        finally:
+            self.release(ckpt, net)
+
+    def _evict(self):
+        while self.used > self.budget:
+            victim = next((ckpt for ckpt, nets in self.idle.items() if nets), None)
+            if victim is None: # everything left is lent out
+                return
+            self.idle[victim].pop()
+            if not self.idle[victim]:
+                del self.idle[victim]
+            self.used -= self.sizes[victim]
+
+# every process keeps its own nets
+POOL = NetPool()
+
+def checkpoint(style):
+    '''The file containing the model for a style'''
+    return MODEL_DIR + '{style}.t7'.format(style=style)
+
+def preload(styles):
+    '''
+    Loads the nets for some styles ahead of time. Styles whose model isn't on
+    disk are skipped; asking for them later fails as usual.
+    '''
+    for style in styles:
+        ckpt = checkpoint(style)
+        if os.path.isfile(ckpt):
+            POOL.release(ckpt, POOL.acquire(ckpt))
 
 def parse_args():
     '''construct the argument parser and parse the arguments'''
@@ -27,15 +113,107 @@ def parse_args():
         help="neural style transfer model")
     ap.add_argument("-i", "--im_name", required=True,
         help="name of input image to apply neural style transfer to")
+    ap.add_argument("--mode", choices=MODES, default=FAST_MODE,
+        help="shrink the image first (fast) or keep its resolution (full)")
     return ap.parse_args()
 
-def style_transfer(image, ckpt):
+def fit_budget(image, max_pixels):
+    '''Shrinks an image, keeping its aspect ratio, to at most max_pixels.'''
+    (h, w) = image.shape[:2]
+    if h * w <= max_pixels:
+        return image
+    scale = (max_pixels / (h * w)) ** 0.5
+    size = (max(1, int(w * scale)), max(1, int(h * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def forward(net, image):
+    '''
+    Runs one image through a network in a single pass, returning the 
+    stylized image as a float32 array of the same size.
+    '''
+    return forward_batch(net, [image])[0]
+
+def forward_batch(net, images):
+    '''
+    Runs several images through a network, one pass per distinct image size.
+    Images are never padded to match one another: that would cost extra work
+    and, since these networks normalize each image over its whole area, 
+    would change the output depending on what else was in the batch.
+    '''
+    results = [None] * len(images)
+    sizes = {}
+    for idx, image in enumerate(images):
+        sizes.setdefault(image.shape[:2], []).append(idx)
+
+    for (h, w), group in sizes.items():
+        # construct a blob from the images, set the input, and then perform a
+        # forward pass of the network
+        blob = cv2.dnn.blobFromImages([images[idx] for idx in group], 1.0, 
+            (w, h), MEAN, swapRB=False, crop=False)
+        net.setInput(blob)
+        outputs = net.forward()
+
+        for idx, output in zip(group, outputs):
+            # add back in the mean subtraction and swap the channel ordering
+            output = output.transpose(1, 2, 0) + np.array(MEAN, dtype=np.float32)
+            if output.shape[:2] != (h, w):
+                output = cv2.resize(output, (w, h))
+            results[idx] = output
+    return results
+
+def tile_starts(length, tile, overlap):
+    '''Where tiles begin along one axis so that they cover all of it.'''
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    return starts + [length - tile]
+
+def ramp(length, overlap, first, last):
+    '''
+    Blending weights along one side of a tile: 1 in the middle, fading 
+    linearly toward the edges that overlap a neighbouring tile.
+    '''
+    weights = np.ones(length, dtype=np.float32)
+    fade = np.linspace(0, 1, overlap + 2, dtype=np.float32)[1:-1]
+    if not first:
+        weights[:overlap] = fade
+    if not last:
+        weights[-overlap:] = fade[::-1]
+    return weights
+
+def forward_tiled(net, image, tile, overlap):
+    '''
+    Stylizes an image in overlapping tiles, so that memory use depends on 
+    the tile size rather than the image size. Where tiles overlap, their 
+    outputs are blended with linearly ramped weights to hide the seams.
+    '''
+    (h, w) = image.shape[:2]
+    output = np.zeros((h, w, 3), dtype=np.float32)
+    total = np.zeros((h, w, 1), dtype=np.float32)
+
+    rows, cols = tile_starts(h, tile, overlap), tile_starts(w, tile, overlap)
+    for i, y in enumerate(rows):
+        for j, x in enumerate(cols):
+            patch = image[y:y + tile, x:x + tile]
+            (th, tw) = patch.shape[:2]
+            weight = np.outer(
+                ramp(th, overlap, i == 0, i == len(rows) - 1),
+                ramp(tw, overlap, j == 0, j == len(cols) - 1))[..., None]
+            output[y:y + th, x:x + tw] += forward(net, patch) * weight
+            total[y:y + th, x:x + tw] += weight
+
+    return output / total
+
+def style_transfer(image, ckpt, mode=FAST_MODE):
     '''
     Applies style tranfer.
     
     args
-        im_name : the name of an input image
+        image   : the image to stylize
         chkpt   : the name of the model to use for style transfer
+        mode    : FAST_MODE shrinks the image to const.STYLIZE_FAST_PIXELS;
+                  FULL_MODE keeps up to const.STYLIZE_FULL_PIXELS, working
+                  in tiles on anything larger than one tile
     '''
     # if no model is chosen, then choose a random one
     #pdb.set_trace()
@@ -43,48 +221,40 @@ def style_transfer(image, ckpt):
         models = os.listdir(MODEL_DIR)
         ckpt = MODEL_DIR + random.choice(models)
     
-    # load the neural style transfer model from disk
-    # print("[INFO] loading style transfer model...")
-    net = cv2.dnn.readNetFromTorch(ckpt)
-    
-    # resize the image to have a width of 600 pixels, and
-    # then grab the image dimensions
+    if mode == FAST_MODE:
+        return style_transfer_batch([image], ckpt)[0]
 
-    imutils.resize(image, width=600)
-    
-    (h, w) = image.shape[:2]
-    
-    # construct a blob from the image, set the input, and then perform a
-    # forward pass of the network
-    blob = cv2.dnn.blobFromImage(image, 1.0, (w, h),
-        (103.939, 116.779, 123.680), swapRB=False, crop=False)
-    net.setInput(blob)
-    output = net.forward()
-
-    # reshape the output tensor, add back in the mean subtraction, and
-    # then swap the channel ordering
-    output = output.reshape((3, output.shape[2], output.shape[3]))
-    output[0] += 103.939
-    output[1] += 116.779
-    output[2] += 123.680
-    output /= 255.0
-    output = output.transpose(1, 2, 0)
-    
-    # print("[INFO] neural style transfer took {:.4f} seconds".format(end - start))
-    
-    return image * 255, output * 255
+    tile = const.STYLIZE_TILE
+    image = fit_budget(image, const.STYLIZE_FULL_PIXELS)
+    with POOL.net(ckpt) as net:
+        if image.shape[0] * image.shape[1] <= tile * tile:
+            output = forward(net, image)
+        else:
+            output = forward_tiled(net, image, tile, const.STYLIZE_TILE_OVERLAP)
+
+    return np.clip(output, 0, 255).astype(np.uint8)
+
+def style_transfer_batch(images, ckpt):
+    '''
+    Applies fast mode style transfer to several images with the same model,
+    in a single forward pass.
+    '''
+    images = [fit_budget(image, const.STYLIZE_FAST_PIXELS) for image in images]
+    with POOL.net(ckpt) as net:
+        outputs = forward_batch(net, images)
+    return [np.clip(output, 0, 255).astype(np.uint8) for output in outputs]
 
 def main():
     args = parse_args()
     
     img_in = cv2.imread(args.im_name)
     
-    image, output = style_transfer(img_in, args.model)
+    output = style_transfer(img_in, args.model, args.mode)
     
     cv2.imwrite('out.png', output)
     
     # show the images
-    cv2.imshow("Input", image)
+    cv2.imshow("Input", img_in)
     cv2.imshow("Output", output)
 
     cv2.waitKey(0)
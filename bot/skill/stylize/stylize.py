@@ -1,9 +1,17 @@
 
 from . import core
+from ... import const
+from ... import engine
+from ... import image
 from .. import skill
 
+# renders the image in every style at once
+ALL_PROMPT = 'all'
+
 class SkillStylize(skill.Skill):
 
+    cpu_bound = True
+
     def __init__(self):
         self.styles = [ 'candy', 
                         'composition_vii', 
@@ -14,51 +22,102 @@ class SkillStylize(skill.Skill):
                         'the_scream',
                         'the_wave', 
                         'udnie' ]
+        # fast mode requests for the same style share a forward pass
+        self.batcher = engine.Batcher(self.stylize_batch, 
+            const.STYLIZE_BATCH_WINDOW, const.STYLIZE_BATCH_SIZE)
         super().__init__()
     
-    def help(self):
-        self.respond(
+    def warmup(self):
+        # load the most popular styles wherever the style transfer will run
+        engine.preload(core.preload, const.STYLIZE_PRELOAD)
+
+    def stylize_batch(self, key, images):
+        '''Stylizes a batch of images gathered by the batcher.'''
+        ckpt, _ = key
+        return self.offload(core.style_transfer_batch, images, ckpt)
+
+    def help(self, ctx):
+        self.respond(ctx,
             'usage:\n' +\
                 '\t@ritai stylize <image>\n' +\
                 '\t\tI will stylize the attached image with a random style.\n' +\
                 '\t@ritai stylize [style] <image>\n' +\
                 '\t\tI will stylize the attached image with a specific style.\n' +\
+                '\t@ritai stylize [style] [fast|full] <image>\n' +\
+                '\t\tfast (the default) shrinks the image first; full keeps\n' +\
+                '\t\tits resolution, but takes longer.\n' +\
+                '\t@ritai stylize all <image>\n' +\
+                '\t\tI will show the attached image in every style side by side.\n' +\
                 '\tNOTE: valid styles include:\n' +\
                 '\t' + str(self.styles) + '\n'
         )
         
-    def execute(self, prompt):
+    def cache_key(self, ctx):
+        '''Only remember results for which the user chose the style (or all of them).'''
+        if not any(arg.lower() in self.styles + [ALL_PROMPT] for arg in ctx.args[1:]):
+            return None
+        return super().cache_key(ctx)
+
+    def execute(self, ctx):
         '''
         Applies style transfer to an image using a neural network.
         '''
-        prompt_list = prompt.split(' ')
+        prompt_list = ctx.args
         style = None
+        mode = core.FAST_MODE
         
-        # what style does the user want?
-        if len(prompt_list) > 1:
-            desire = prompt_list[1].lower()
-            if desire in self.styles:
+        # does the user want to compare every style?
+        if len(prompt_list) == 2 and prompt_list[1].lower() == ALL_PROMPT:
+            self.stylize_all(ctx)
+            return
+
+        # warn the user if they provided too many arguments
+        if len(prompt_list) > 3:
+            self.respond(ctx, 'Invalid numer of arguments: %d' % len(prompt_list))
+            return
+
+        # what style (and how much resolution) does the user want?
+        for arg in prompt_list[1:]:
+            desire = arg.lower()
+            if desire in self.styles and not style:
                 style = desire
+            elif desire in core.MODES:
+                mode = desire
             else:
-                self.respond(
+                self.respond(ctx,
                     'I don\'t recognize the style %s. Try @ritai help ' % desire +\
                     'stylize for available styles.'
                 )
                 return
-        # warn the user if they provided too many arguments
-        if len(prompt_list) > 2:
-            self.respond('Invalid numer of arguments: %d' % len(prompt_list))
-            return
         
         if not style:
             style = core.random.choice(self.styles)
         
-        ckpt = core.MODEL_DIR + '{style}.t7'.format(style=style)
+        ckpt = core.checkpoint(style)
         
         # perform style transfer
-        img = self.read_image()
-        _, output = core.style_transfer(img, ckpt)
-        self.write_image(output)
+        img = self.read_image(ctx)
+        if mode == core.FAST_MODE:
+            # shrink the image before it is sent to another process
+            img = core.fit_budget(img, const.STYLIZE_FAST_PIXELS)
+            # only images of the same size can share a forward pass
+            output = self.batcher.submit((ckpt, img.shape), img)
+        else:
+            output = self.offload(core.style_transfer, img, ckpt, mode)
+        self.write_image(ctx, output)
         
         # post image to channel
-        self.upload_image(('style: %s' % style))
+        self.upload_image(ctx, ('style: %s' % style))
+
+    def stylize_all(self, ctx):
+        '''
+        Renders the image in every style, one style per worker process, and
+        uploads the results together on a contact sheet.
+        '''
+        img = core.fit_budget(self.read_image(ctx), const.STYLIZE_FAST_PIXELS)
+        ckpts = [core.checkpoint(style) for style in self.styles]
+        outputs = self.offload_map(core.style_transfer, [img] * len(ckpts), ckpts)
+        self.write_image(ctx, image.contact_sheet(outputs, self.styles))
+
+        # post image to channel
+        self.upload_image(ctx, 'every style')
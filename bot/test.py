@@ -6,44 +6,152 @@
 # 2) Do all the skills work?
 
 from . import bot
-from . import const
+from . import image
+from . import engine
+from . import context
+from .skill import skill
 
+import io
+import time
+import threading
 import traceback as track
 from PIL import Image
 
 class MockClient():
+    token = 'MOCK_TOKEN'
+
     def api_call(self, **kwargs):
         bot.log(f'Message sent via API:\n' +\
             '\n'.join([f'\t{key}:\t{val}' for key, val in kwargs.items()]))
-            
-MOCK_INFO = {
-    const.INFO_CLIENT: MockClient(), 
-    const.INFO_CHANNEL: 'MOCK_CHANNEL', 
-    const.INFO_THREAD: 'MOCK_THREAD'
-}
+
+MOCK_IMAGE = image.RequestImage()
+
+def mock_context(prompt):
+    '''Builds the context of a prompt sent from a mocked Slack environment'''
+    return context.Context(MockClient(), 'MOCK_CHANNEL', 'MOCK_THREAD', prompt, 
+        img=image.RequestImage(MOCK_IMAGE.data))
 
 def gen_mock_image():
     img = Image.new('RGB', (800,1280), (255, 255, 255))
-    img.save(const.TEMP_PATH / const.IN_IMG_NAME, 'PNG')
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    MOCK_IMAGE.data = buf.getvalue()
 
 def test_slack_client():
     return bot.launch_bot()
 
 def test_help():
-    bot.handle_prompt('help kmeans', MOCK_INFO)
+    bot.handle_prompt(mock_context('help kmeans'))
 
 def test_mnist():
-    bot.handle_prompt('mnist', MOCK_INFO)
+    bot.handle_prompt(mock_context('mnist'))
 
 def test_kmeans():
-    bot.handle_prompt('kmeans 7', MOCK_INFO)
+    bot.handle_prompt(mock_context('kmeans 7'))
 
 def test_stylize():
-    bot.handle_prompt('stylize', MOCK_INFO)
-    bot.handle_prompt('stylize mosaic', MOCK_INFO)
+    bot.handle_prompt(mock_context('stylize'))
+    bot.handle_prompt(mock_context('stylize mosaic'))
+    bot.handle_prompt(mock_context('stylize mosaic full'))
+    bot.handle_prompt(mock_context('stylize all'))
 
 def test_caption():
-    bot.handle_prompt('caption', MOCK_INFO)
+    bot.handle_prompt(mock_context('caption'))
+
+def test_memoize():
+    first, second = mock_context('mnist'), mock_context('mnist')
+    bot.handle_prompt(first)
+    hits = bot.cache.results.hits
+    bot.handle_prompt(second)
+    return bot.cache.results.hits == hits + 1 and first.replies == second.replies
+
+def test_memoize_own_replies():
+    first, second = mock_context('kmeans 3 hist'), mock_context('kmeans 3 hist')
+    bot.respond(first, 'Queued, position 2.')
+    bot.handle_prompt(first)
+    bot.handle_prompt(second)
+    # only what the skill said is repeated, not what was said before it ran
+    return second.replies == first.replies[1:]
+
+def wait_for_followers(inflight, key, count=1):
+    '''Blocks (from inside a job) until count callers wait for its result.'''
+    while inflight.followers.get(key, 0) < count:
+        time.sleep(0.001)
+
+def run_overlapping(leader, follower, started):
+    '''
+    Runs leader() on one thread and, once started is set, follower() on 
+    another, then waits for both.
+    '''
+    threads = [threading.Thread(target=leader)]
+    threads[0].start()
+    started.wait()
+    threads.append(threading.Thread(target=follower))
+    threads[1].start()
+    for thread in threads:
+        thread.join()
+
+def test_coalesce():
+    inflight = engine.Coalescer()
+    started, calls = threading.Event(), []
+    def job():
+        calls.append(1)
+        started.set()
+        wait_for_followers(inflight, 'key')
+        return 'done'
+    run_overlapping(lambda: inflight.run('key', job),
+        lambda: calls.append(inflight.run('key', job)), started)
+    # the job ran once, and the follower got its result without running it
+    return calls == [1, ('done', False)]
+
+def test_coalesce_own_replies():
+    started = threading.Event()
+    class SkillSlow(skill.Skill):
+        def help(self, ctx):
+            pass
+        def execute(self, ctx):
+            started.set()
+            wait_for_followers(bot.INFLIGHT, self.cache_key(ctx))
+            self.respond(ctx, 'done')
+    slow = SkillSlow()
+    first, second = mock_context('slow'), mock_context('slow')
+    bot.respond(first, 'Queued, position 1.')
+    run_overlapping(lambda: bot.run_skill(slow, first),
+        lambda: bot.run_skill(slow, second), started)
+    # the follower hears the answer, but not where the leader was queued
+    return second.replies == [('text', 'done')]
+
+def test_parse():
+    mention = lambda text, ts: {'type': 'message', 'text': '<@UBOT> ' + text,
+        'channel': 'MOCK_CHANNEL', 'ts': ts}
+    events = [mention('mnist', '1'), {'type': 'hello'}, mention('kmeans 3', '2')]
+    commands = bot.parse_bot_commands(events, 'UBOT')
+    return [command[0] for command in commands] == ['mnist', 'kmeans 3']
+
+def test_engine():
+    workers = engine.Engine(bot.handle_prompt, threads=2, depth=1)
+    positions = [workers.submit(mock_context('kmeans 3')) for _ in range(4)]
+    workers.shutdown()
+    # two commands run right away, one waits, and the last is turned away
+    return positions == [0, 0, 1, None]
+
+def test_batch():
+    batches = []
+    def double(key, items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+    batcher = engine.Batcher(double, window=0.5, max_size=3)
+    results = {}
+    def submit(item):
+        results[item] = batcher.submit('key', item)
+    threads = [threading.Thread(target=submit, args=(item,)) for item in range(4)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01) # keep the items in order
+    for thread in threads:
+        thread.join()
+    # the first three fill a batch; the last one waits out the window alone
+    return batches == [[0, 1, 2], [3]] and results == {0: 0, 1: 2, 2: 4, 3: 6}
 
 def test(idx, function):
     bot.log(f'Test {idx}: {function.__name__}')
@@ -72,7 +180,14 @@ def main():
         test_mnist,
         test_kmeans,
         test_stylize,
-        test_caption
+        test_caption,
+        test_memoize,
+        test_memoize_own_replies,
+        test_coalesce,
+        test_coalesce_own_replies,
+        test_parse,
+        test_engine,
+        test_batch
     ]
 
     for idx in range(len(suite)):
@@ -1,4 +1,5 @@
-import os
-from bot import bot
-
-bot.main()
+import os
+from bot import bot
+
+if __name__ == '__main__':
+    bot.main()